@@ -0,0 +1,55 @@
+"""سنجش تأخیر تخصیص محموله بین چند بیمه‌نامه
+
+اجرا: python benchmarks/bench_allocation.py [تعداد بیمه‌نامه‌های شرکت] [تعداد محموله‌ها]
+"""
+import sys
+import time
+import random
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from insurance_system import DatabaseManager, ALLOCATION_STRATEGIES, allocate_shipment
+
+
+def make_policies(count):
+    random.seed(1)
+    return [(i, str(i), f"{1400 + i % 5}/{1 + i % 12:02d}/{1 + i % 28:02d}", 10 ** 9, random.randint(1, 10 ** 9))
+            for i in range(1, count + 1)]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    shipments = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    policies = make_policies(count)
+    # هر محموله به‌طور میانگین حدود پنج بیمه‌نامه نیاز دارد
+    values = [random.randint(10 ** 9, 5 * 10 ** 9) for _ in range(shipments)]
+
+    for strategy in ALLOCATION_STRATEGIES:
+        parts = 0
+        start = time.perf_counter()
+        for value in values:
+            parts += len(allocate_shipment(policies, value, strategy))
+        elapsed = (time.perf_counter() - start) / shipments
+        print(f"{'plan ' + strategy:<32}{elapsed * 1e3:10.3f} ms  {parts / shipments:5.1f} policies/shipment")
+
+    with tempfile.TemporaryDirectory() as directory:
+        manager = DatabaseManager(str(Path(directory) / "bench.db"))
+        manager.add_company("company")
+        with manager.connection() as conn:
+            conn.executemany('INSERT INTO policies (company_name, policy_number, policy_date, total_value, remaining_value) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             [("company", number, date, total, remaining)
+                              for _, number, date, total, remaining in make_policies(count)])
+        for strategy in ALLOCATION_STRATEGIES:
+            start = time.perf_counter()
+            for value in values[:50]:
+                success, _ = manager.add_allocated_certificates("1404/01/01", "company", "123", 1, value // 10, strategy)
+                assert success
+            elapsed = (time.perf_counter() - start) / 50
+            print(f"{'issue ' + strategy:<32}{elapsed * 1e3:10.3f} ms")
+        manager.close_connections()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""سنجش بایگانی و بازیابی گواهی‌های چاپ‌شده در بایگانی محتوا-محور
+
+اجرا: python benchmarks/bench_certificate_archive.py [تعداد گواهی‌ها] [اندازه دسته]
+"""
+import sys
+import time
+import random
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from insurance_system import CertificateArchive, TenantRegistry, DEFAULT_TENANT
+
+
+def render(template, sanad_id):
+    remaining = 10 ** 9 - sanad_id * 1000
+    return template.safe_substitute(
+        sanad_id=sanad_id, sanad_date="1404/01/01", company_name=f"company {sanad_id % 50}",
+        policy_number=str(sanad_id % 500), policy_date="1403/12/01", cottage_numbers=f"{sanad_id}, {sanad_id + 1}",
+        count=2, total_value=f"{10 ** 9:,}", value=f"{1000:,}", remaining_after=f"{remaining:,}")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    batch = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    template = TenantRegistry.single(DEFAULT_TENANT["db_path"]).certificate_template("default")
+    with tempfile.TemporaryDirectory() as directory:
+        archive = CertificateArchive(directory)
+        raw_bytes = 0
+        start = time.perf_counter()
+        for first in range(1, count + 1, batch):
+            documents = [(sanad_id, render(template, sanad_id)) for sanad_id in range(first, min(first + batch, count + 1))]
+            raw_bytes += sum(len(html.encode("utf-8")) for _, html in documents)
+            archive.store_many(documents)
+        stored = time.perf_counter() - start
+        packed_bytes = archive.pack_path.stat().st_size
+        print(f"{'archive':<24}{stored:8.2f} s  {count / stored:10.0f} cert/s")
+        print(f"{'raw / packed':<24}{raw_bytes / 2 ** 20:8.1f} MiB / {packed_bytes / 2 ** 20:.1f} MiB"
+              f"  ({raw_bytes / packed_bytes:.1f}x)")
+
+        archive.close()
+        archive = CertificateArchive(directory)
+        start = time.perf_counter()
+        fetched = sum(1 for _ in archive.get_many())
+        bulk = time.perf_counter() - start
+        print(f"{'bulk fetch':<24}{bulk:8.2f} s  {fetched / bulk:10.0f} cert/s")
+
+        random.seed(1)
+        sample = [random.randint(1, count) for _ in range(min(count, 10000))]
+        start = time.perf_counter()
+        for sanad_id in sample:
+            archive.get(sanad_id)
+        reprint = (time.perf_counter() - start) / len(sample)
+        print(f"{'reprint (random get)':<24}{reprint * 1e6:8.1f} us")
+        archive.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""مقایسه تجمیع کامل جدول گواهی‌ها از مسیر SQL و از کش ستونی (سرد و گرم)
+
+اجرا: python benchmarks/bench_columnar_snapshot.py [تعداد گواهی‌ها] [تعداد بیمه‌نامه‌ها]
+
+حالت سرد در یک پردازه تازه و پس از خارج کردن فایل‌های ستونی از page cache سیستم‌عامل
+(posix_fadvise با POSIX_FADV_DONTNEED) اندازه‌گیری می‌شود.
+"""
+import os
+import sys
+import subprocess
+import time
+import random
+import sqlite3
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from insurance_system import DatabaseManager, ColumnarSnapshot
+
+
+def build_database(db_path, certificates, policies):
+    DatabaseManager(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        'INSERT INTO policies (company_name, policy_number, policy_date, total_value, remaining_value) VALUES (?, ?, ?, ?, ?)',
+        ((f"company{i % 500}", str(i), "1404/01/01", 10 ** 12, 10 ** 12) for i in range(policies)))
+    days = [f"1404/{m:02d}/{d:02d}" for m in range(1, 13) for d in range(1, 30)]
+    conn.executemany(
+        'INSERT INTO certificates (sanad_id, sanad_date, company_name, policy_id, policy_number, policy_date, '
+        'cottage_numbers, count, value, remaining_after) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        ((4000 + i, random.choice(days), "company", random.randint(1, policies), "0", "1404/01/01",
+          str(1000000 + i), 1, random.randint(1, 10 ** 6), 0) for i in range(certificates)))
+    conn.commit()
+    conn.close()
+
+
+def drop_page_cache(directory):
+    """خارج کردن فایل‌های ستونی از page cache؛ روی سیستم‌هایی که fadvise ندارند False برمی‌گردد"""
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    for path in Path(directory).glob("*.i8"):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return True
+
+
+def snapshot_aggregate(snapshot):
+    return np.bincount(snapshot.column('certificates', 'policy_id'),
+                       weights=snapshot.column('certificates', 'value'))
+
+
+def cold_aggregate(db_path, directory):
+    """اجرا در پردازه فرزند: باز کردن کش و اولین تجمیع بدون داده‌ای در حافظه پردازه"""
+    start = time.perf_counter()
+    snapshot_aggregate(ColumnarSnapshot(db_path, directory))
+    print(time.perf_counter() - start)
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    print(f"{label:<32}{time.perf_counter() - start:8.3f} s")
+    return result
+
+
+def main():
+    certificates = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    policies = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = str(Path(directory) / "bench.db")
+        timed(f"build {certificates:,} rows", lambda: build_database(db_path, certificates, policies))
+
+        def sql_aggregate():
+            conn = sqlite3.connect(db_path)
+            rows = conn.execute('SELECT policy_id, SUM(value) FROM certificates GROUP BY policy_id').fetchall()
+            conn.close()
+            return dict(rows)
+
+        expected = timed("SQL GROUP BY", sql_aggregate)
+        snapshot = ColumnarSnapshot(db_path, Path(directory) / "columns")
+        timed("snapshot initial refresh", snapshot.refresh)
+
+        columns = str(Path(directory) / "columns")
+        label = "snapshot cold aggregate" if drop_page_cache(columns) else "snapshot new-process aggregate"
+        elapsed = float(subprocess.run([sys.executable, __file__, "--cold", db_path, columns],
+                                       check=True, capture_output=True, text=True).stdout)
+        print(f"{label:<32}{elapsed:8.3f} s")
+
+        warm = ColumnarSnapshot(db_path, columns)
+        totals = timed("snapshot warm aggregate", lambda: snapshot_aggregate(warm))
+        timed("snapshot no-op refresh", warm.refresh)
+
+        assert all(totals[policy_id] == total for policy_id, total in expected.items())
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--cold"]:
+        cold_aggregate(sys.argv[2], sys.argv[3])
+    else:
+        main()
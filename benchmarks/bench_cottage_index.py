@@ -0,0 +1,109 @@
+"""سنجش ساخت و جستجوی ایندکس کوتاژهای تقریباً تکراری در برابر جستجوی LIKE
+
+اجرا: python benchmarks/bench_cottage_index.py [تعداد گواهی‌ها] [تعداد جستجوها]
+"""
+import sys
+import time
+import threading
+import random
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from insurance_system import DatabaseManager, CottageIndex
+
+
+def cottage(i):
+    # شماره‌های پشت‌سرهم با پیشوند مشترک، مانند شماره‌های واقعی گمرک
+    return str(14030000000 + i * 7)
+
+
+def build_database(path, count):
+    manager = DatabaseManager(path)
+    manager.add_company("company")
+    policy_id = manager.add_policy("company", "1", "1404/01/01", 10 ** 15)
+    with manager.connection() as conn:
+        conn.executemany(
+            'INSERT INTO certificates (sanad_id, sanad_date, company_name, policy_id, policy_number, policy_date, '
+            'cottage_numbers, count, value, remaining_after) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            ((4000 + i, "1404/01/01", "company", policy_id, "1", "1404/01/01",
+              cottage(i) if i % 3 else f"{cottage(i)}-{cottage(i) + '1'}", 1, 1000, 0) for i in range(count)))
+    return manager
+
+
+def typo(text):
+    digits = list(text)
+    position = random.randrange(len(digits) - 1)
+    kind = random.randrange(3)
+    if kind == 0:
+        digits[position], digits[position + 1] = digits[position + 1], digits[position]
+    elif kind == 1:
+        digits[position] = str((int(digits[position]) + 1) % 10)
+    else:
+        del digits[position]
+    return "".join(digits)
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    with tempfile.TemporaryDirectory() as directory:
+        manager = build_database(str(Path(directory) / "bench.db"), count)
+        index = CottageIndex()
+        start = time.perf_counter()
+        index.refresh(manager)
+        print(f"{'build':<28}{time.perf_counter() - start:10.2f} s  ({len(index.cottages)} cottages)")
+
+        random.seed(1)
+        queries = [typo(cottage(random.randrange(count))) for _ in range(lookups)]
+        samples = []
+        found = 0
+        for query in queries:
+            start = time.perf_counter()
+            found += bool(index.search(query))
+            samples.append(time.perf_counter() - start)
+        print(f"{'fuzzy search p50 / p99':<28}{percentile(samples, 0.5) * 1e3:10.3f} / {percentile(samples, 0.99) * 1e3:.3f} ms")
+        print(f"{'typos detected':<28}{found / lookups:10.1%}")
+
+        start = time.perf_counter()
+        for query in queries[:20]:
+            manager.check_cottage_exists(query)
+        print(f"{'LIKE check_cottage_exists':<28}{(time.perf_counter() - start) / 20 * 1e3:10.3f} ms")
+
+        start = time.perf_counter()
+        for i in range(1000):
+            with manager.connection() as conn:
+                conn.execute('INSERT INTO certificates (sanad_id, sanad_date, company_name, policy_id, policy_number, '
+                             'policy_date, cottage_numbers, count, value, remaining_after) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (10 ** 7 + i, "1404/01/01", "company", 1, "1", "1404/01/01", cottage(count + i), 1, 1000, 0))
+            index.refresh(manager)
+        print(f"{'insert + refresh':<28}{(time.perf_counter() - start) / 1000 * 1e3:10.3f} ms")
+
+        # جستجو هم‌زمان با ادغام یک دسته‌ی بزرگ؛ ادغام نباید جستجو را پشت قفل نگه دارد
+        with manager.connection() as conn:
+            conn.executemany('INSERT INTO certificates (sanad_id, sanad_date, company_name, policy_id, policy_number, '
+                             'policy_date, cottage_numbers, count, value, remaining_after) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             ((2 * 10 ** 7 + i, "1404/01/01", "company", 1, "1", "1404/01/01",
+                               cottage(2 * count + i), 1, 1000, 0) for i in range(max(count // 10, 1000))))
+        worker = threading.Thread(target=index.refresh, args=(manager,))
+        worker.start()
+        samples = []
+        while worker.is_alive():
+            start = time.perf_counter()
+            index.search(queries[len(samples) % lookups])
+            samples.append(time.perf_counter() - start)
+        worker.join()
+        if samples:
+            print(f"{'search during merge p99':<28}{percentile(samples, 0.99) * 1e3:10.3f} ms  ({len(samples)} searches)")
+        manager.close_connections()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""مجموعه سنجش مشترک پشتیبان‌های ذخیره‌سازی DatabaseManager
+
+بار کاری یکسان روی SQLite (فایل موقت) و در صورت دادن DSN روی PostgreSQL اجرا می‌شود. پایگاه PostgreSQL
+باید یک پایگاه دورریختنی باشد؛ همه جدول‌های برنامه پیش از اجرا خالی می‌شوند. با آرگومان disposable یک
+خوشه موقت PostgreSQL با initdb و pg_ctl (از PATH یا پوشه PG_BIN) روی سوکت محلی ساخته و در پایان حذف می‌شود.
+
+اجرا: python benchmarks/bench_storage_backends.py [تعداد گواهی‌ها] [تعداد نخ‌ها] [postgresql DSN | disposable]
+"""
+import os
+import sys
+import time
+import shutil
+import threading
+import subprocess
+import tempfile
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from insurance_system import DatabaseManager, TenantRegistry
+
+TABLES = ("certificates", "certificate_links", "policy_changes", "policies", "companies", "alerts",
+          "alert_thresholds", "settings")
+
+
+@contextmanager
+def disposable_postgres(directory):
+    """خوشه PostgreSQL موقت فقط با سوکت یونیکس؛ DSN آن برگردانده می‌شود"""
+    pg_bin = os.environ.get("PG_BIN")
+    initdb = str(Path(pg_bin) / "initdb") if pg_bin else shutil.which("initdb")
+    pg_ctl = str(Path(pg_bin) / "pg_ctl") if pg_bin else shutil.which("pg_ctl")
+    if not initdb or not pg_ctl:
+        raise SystemExit("initdb/pg_ctl not found; set PG_BIN or pass a DSN")
+    data = Path(directory) / "pgdata"
+    subprocess.run([initdb, "-D", str(data), "-U", "bench", "-A", "trust", "--no-sync"], check=True,
+                   stdout=subprocess.DEVNULL)
+    subprocess.run([pg_ctl, "-D", str(data), "-l", str(Path(directory) / "pg.log"), "-w", "start",
+                    "-o", f"-k {directory} -c listen_addresses='' -c fsync=off"], check=True, stdout=subprocess.DEVNULL)
+    try:
+        yield f"host={directory} dbname=postgres user=bench"
+    finally:
+        subprocess.run([pg_ctl, "-D", str(data), "-m", "immediate", "stop"], stdout=subprocess.DEVNULL)
+
+
+def open_manager(tenant, threads):
+    manager = DatabaseManager(tenants=TenantRegistry([tenant]), pool_size=threads)
+    with manager.connection() as conn:
+        for table in TABLES:
+            conn.execute(f'DELETE FROM {table}')
+    return manager
+
+
+def timed(results, label, count, function):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    results.append((label, elapsed / count))
+
+
+def issue(manager, policies, count, offset=0):
+    for i in range(count):
+        policy_id, company, number = policies[(offset + i) % len(policies)]
+        manager.add_certificate(None, "1404/01/01", company, policy_id, number, "1404/01/01",
+                                str(100000 + offset + i), 1, 1000)
+
+
+def run(tenant, certificates, threads):
+    manager = open_manager(tenant, threads)
+    results = []
+    companies = [f"company {i}" for i in range(50)]
+    timed(results, "add_company", len(companies), lambda: [manager.add_company(name) for name in companies])
+    policies = []
+
+    def add_policies():
+        for i in range(500):
+            company = companies[i % len(companies)]
+            policies.append((manager.add_policy(company, str(i), "1404/01/01", 10 ** 12), company, str(i)))
+    timed(results, "add_policy", 500, add_policies)
+    timed(results, "add_certificate", certificates, lambda: issue(manager, policies, certificates))
+    timed(results, "get_policies(company)", 1000, lambda: [manager.get_policies(companies[i % 50]) for i in range(1000)])
+    timed(results, "get_policies()", 20, lambda: [manager.get_policies() for _ in range(20)])
+    timed(results, "check_cottage_exists", 200, lambda: [manager.check_cottage_exists(str(100000 + i)) for i in range(200)])
+
+    # همه نخ‌ها روی یک بیمه‌نامه؛ قفل مانده نباید اجازه برداشت بیش از ارزش کل را بدهد
+    policy_id = manager.add_policy(companies[0], "shared", "1404/01/01", 1000 * certificates)
+    shared = [(policy_id, companies[0], "shared")]
+    per_thread = certificates // threads
+    workers = [threading.Thread(target=issue, args=(manager, shared, per_thread, certificates * (t + 1)))
+               for t in range(threads)]
+
+    def contend():
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    timed(results, f"add_certificate x{threads} threads", per_thread * threads, contend)
+    remaining = [row[5] for row in manager.get_policies() if row[0] == policy_id][0]
+    consistent = remaining == 1000 * (certificates - per_thread * threads)
+    with manager.connection() as conn:
+        issued, distinct = conn.execute('SELECT COUNT(*), COUNT(DISTINCT sanad_id) FROM certificates').fetchone()
+    manager.close_connections()
+    return results, consistent, issued == distinct
+
+
+def main():
+    certificates = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    dsn = sys.argv[3] if len(sys.argv) > 3 else None
+    with tempfile.TemporaryDirectory() as directory:
+        backends = [("sqlite", {"code": "bench", "db_path": str(Path(directory) / "bench.db")})]
+        with disposable_postgres(directory) if dsn == "disposable" else nullcontext(dsn) as dsn:
+            if dsn:
+                backends.append(("postgresql", {"code": "bench", "backend": "postgresql", "dsn": dsn}))
+            for name, tenant in backends:
+                results, consistent, unique = run(tenant, certificates, threads)
+                print(name)
+                for label, seconds in results:
+                    print(f"  {label:<32}{seconds * 1e6:10.1f} us")
+                print(f"  {'balance consistent':<32}{consistent!s:>10}")
+                print(f"  {'sanad ids unique':<32}{unique!s:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""سنجش هزینه جابه‌جایی بین نمایندگی‌ها با کش LRU اتصال‌ها
+
+اجرا: python benchmarks/bench_tenant_switching.py [تعداد نمایندگی‌ها] [تعداد جابه‌جایی‌ها]
+"""
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from insurance_system import DatabaseManager, TenantRegistry
+
+
+def build_tenants(directory, count):
+    tenants = TenantRegistry([{"code": f"t{i}", "agency_code": str(6000 + i),
+                               "db_path": str(Path(directory) / f"t{i}.db")} for i in range(count)])
+    manager = DatabaseManager(tenants=tenants, max_open_connections=count)
+    for code in tenants.codes():
+        manager.use_tenant(code)
+        manager.add_company("company")
+        for p in range(20):
+            manager.add_policy("company", str(p), "1404/01/01", 10 ** 9)
+    manager.close_connections()
+    return tenants
+
+
+def run(tenants, switches, budget):
+    manager = DatabaseManager(tenants=tenants, max_open_connections=budget)
+    codes = tenants.codes()
+    random.seed(1)
+    order = [random.choice(codes) for _ in range(switches)]
+    start = time.perf_counter()
+    for code in order:
+        manager.use_tenant(code)
+        manager.get_policies("company")
+    elapsed = time.perf_counter() - start
+    manager.close_connections()
+    return elapsed / switches
+
+
+def run_uncached(tenants, switches):
+    # مسیر قبلی: یک اتصال جدید برای هر فراخوانی
+    codes = tenants.codes()
+    random.seed(1)
+    order = [random.choice(codes) for _ in range(switches)]
+    start = time.perf_counter()
+    for code in order:
+        conn = sqlite3.connect(tenants.get(code)["db_path"])
+        conn.execute('SELECT id, policy_number, policy_date, total_value, remaining_value FROM policies '
+                     'WHERE company_name = ? AND remaining_value > 0 ORDER BY policy_number', ("company",)).fetchall()
+        conn.close()
+    return (time.perf_counter() - start) / switches
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    switches = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    with tempfile.TemporaryDirectory() as directory:
+        tenants = build_tenants(directory, count)
+        print(f"{count} tenants, {switches:,} random switches + get_policies")
+        print(f"{'new connection per call':<32}{run_uncached(tenants, switches) * 1e6:10.1f} us")
+        for budget in (8, 32, 128, count):
+            print(f"{f'LRU budget {budget}':<32}{run(tenants, switches, budget) * 1e6:10.1f} us")
+
+        data = {"sanad_id": 4000, "sanad_date": "1404/01/01", "company_name": "company", "policy_number": "1",
+                "policy_date": "1404/01/01", "total_value": 10 ** 9, "cottage_numbers": "123", "count": 1,
+                "value": 1000, "remaining_after": 10 ** 9 - 1000}
+        start = time.perf_counter()
+        for code in tenants.codes():
+            tenants.certificate_template(code)
+        compiled = (time.perf_counter() - start) / count
+        start = time.perf_counter()
+        for _ in range(switches):
+            tenants.certificate_template(random.choice(tenants.codes())).safe_substitute(data)
+        rendered = (time.perf_counter() - start) / switches
+        print(f"{'template compile (first use)':<32}{compiled * 1e6:10.1f} us")
+        print(f"{'template render (cached)':<32}{rendered * 1e6:10.1f} us")
+
+
+if __name__ == "__main__":
+    main()
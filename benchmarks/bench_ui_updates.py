@@ -0,0 +1,74 @@
+"""سنجش تأخیر بروزرسانی رابط کاربری پس از صدور گواهی با ۱۰۰ هزار بیمه‌نامه بارگذاری‌شده
+
+اعمال رویدادهای تغییر (فقط سطر تغییرکرده) با بارگذاری کامل جدول و مدل بیمه‌نامه‌ها مقایسه می‌شود.
+اجرا: python benchmarks/bench_ui_updates.py [تعداد بیمه‌نامه‌ها] [تعداد گواهی‌ها]
+"""
+import os
+import sys
+import time
+import tempfile
+from pathlib import Path
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from PyQt6.QtWidgets import QApplication
+from insurance_system import DatabaseManager, InsuranceSystem
+
+
+def build_database(path, policies):
+    manager = DatabaseManager(path)
+    companies = [f"company {i:03d}" for i in range(100)]
+    with manager.connection() as conn:
+        conn.executemany('INSERT INTO companies (name) VALUES (?)', [(name,) for name in companies])
+        conn.executemany(
+            'INSERT INTO policies (company_name, policy_number, policy_date, total_value, remaining_value) '
+            'VALUES (?, ?, ?, ?, ?)',
+            ((companies[i % 100], f"{i:06d}", "1404/01/01", 10 ** 12, 10 ** 12) for i in range(policies)))
+    manager.close_connections()
+
+
+def main():
+    policies = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    certificates = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    app = QApplication(sys.argv)
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        build_database("insurance_system.db", policies)
+        window = InsuranceSystem()
+        window.show()
+        company = "company 007"
+        window.company_combo_cert.setCurrentIndex(window.company_model.row_of(company))
+        app.processEvents()
+        targets = window.db_manager.get_policies(company)
+        manager = window.db_manager
+
+        def issue(i):
+            policy_id, policy_number = targets[i % len(targets)][:2]
+            manager.add_certificate(None, "1404/01/01", company, policy_id, policy_number,
+                                    "1404/01/01", str(10 ** 9 + i), 1, 1000)
+
+        start = time.perf_counter()
+        for i in range(certificates):
+            issue(i)
+            app.processEvents()
+        delta = (time.perf_counter() - start) / certificates
+
+        start = time.perf_counter()
+        for i in range(certificates, certificates + 10):
+            issue(i)
+            # مسیر قبلی: بارگذاری دوباره کل جدول و مدل بیمه‌نامه‌ها
+            window.update_policies_table()
+            window.policy_model.invalidate()
+            app.processEvents()
+        full = (time.perf_counter() - start) / 10
+
+        print(f"{'policies loaded':<32}{window.policy_table_model.rowCount():10d}")
+        print(f"{'issue + delta events':<32}{delta * 1e3:10.2f} ms")
+        print(f"{'issue + full reload':<32}{full * 1e3:10.2f} ms")
+        window.audit_log.close()
+        window.db_manager.close_connections()
+        os.chdir("/")
+
+
+if __name__ == "__main__":
+    main()
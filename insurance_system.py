@@ -2,176 +2,2747 @@ import sys
 import os
 import json
 import sqlite3
-from datetime import datetime
+from datetime import date, datetime
 from pathlib import Path
 import shutil
+from contextlib import contextmanager
+import argparse
+import atexit
+import bisect
+import copy
+import getpass
+import hashlib
+import heapq
+import itertools
+import mmap
+import multiprocessing
+import queue
+import threading
+import urllib.request
+import zlib
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from string import Template
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, 
                             QWidget, QPushButton, QComboBox, QLineEdit, QLabel, 
-                            QTableWidget, QTableWidgetItem, QTextEdit, QMessageBox,
+                            QTableWidget, QTableWidgetItem, QTableView, QTextEdit, QMessageBox,
                             QTabWidget, QFrame, QScrollArea, QGroupBox, QSpinBox,
                             QFileDialog, QDialog, QDialogButtonBox, QFormLayout,
-                            QCheckBox)
-from PyQt6.QtCore import Qt, QSettings, pyqtSignal, QThread, pyqtSlot
+                            QCheckBox, QListWidget, QSystemTrayIcon, QCompleter, QStyle)
+from PyQt6.QtCore import Qt, QSettings, pyqtSignal, QThread, pyqtSlot, QAbstractListModel, QAbstractTableModel, QModelIndex
 from PyQt6.QtGui import QFont, QPalette, QColor, QLinearGradient, QBrush, QPixmap, QPainter
 
+AUDIT_GENESIS = "0" * 64
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class AuditLog:
+    """دفتر ممیزی فقط-افزودنی با زنجیره هش
+
+    هر سطر به شکل «JSON<TAB>hash» است و hash = sha256(hash سطر قبل + JSON).
+    نوشتن در یک نخ جداگانه و به صورت گروهی انجام می‌شود: همه رکوردهای در صف با یک write و یک fsync ثبت می‌شوند
+    و فراخواننده منتظر دیسک نمی‌ماند مگر آنکه wait=True بدهد.
+
+    پس از هر fsync شماره و هش آخرین رکورد در فایل کناری «.head» نوشته می‌شود. اگر هنگام باز کردن، دفتر از head
+    کوتاه‌تر باشد شماره‌گذاری از head ادامه می‌یابد تا حذف انتهای دفتر به صورت شکاف در seq دیده شود.
+    اگر نخ نویسنده با خطا متوقف شود، record و wait_for همان خطا را بالا می‌برند.
+    """
+
+    def __init__(self, path, max_batch=1000):
+        self.path = Path(path)
+        self.head_path = self.path.with_name(self.path.name + ".head")
+        self.max_batch = max_batch
+        try:
+            self.user = getpass.getuser()
+        except Exception:
+            self.user = "unknown"
+        self.seq, self.last_hash = self.recover_tail()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.written = threading.Condition(self.lock)
+        self.enqueued = 0
+        self.durable = 0
+        self.error = None
+        self.closed = False
+        self.file = open(self.path, "ab")
+        self.writer = threading.Thread(target=self.write_loop, name="audit-writer", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def recover_tail(self):
+        """شماره و هش آخرین رکورد کامل؛ شماره هرگز از head عقب‌تر نمی‌رود"""
+        seq, last_hash = self.read_tail()
+        head = read_audit_head(self.path)
+        if head is not None and head["seq"] > seq:
+            seq = head["seq"]
+        return seq, last_hash
+
+    def read_tail(self):
+        """خواندن شماره و هش آخرین رکورد کامل از انتهای فایل؛ بایت‌های نیمه‌نوشته حذف می‌شوند"""
+        if not self.path.exists() or self.path.stat().st_size == 0:
+            return 0, AUDIT_GENESIS
+        with open(self.path, "r+b") as f:
+            size = f.seek(0, os.SEEK_END)
+            position = size
+            tail = b""
+            while position > 0 and tail.count(b"\n") < 2:
+                step = min(4096, position)
+                position -= step
+                f.seek(position)
+                tail = f.read(step) + tail
+            end = tail.rfind(b"\n")
+            if end == -1:
+                f.truncate(0)
+                return 0, AUDIT_GENESIS
+            if position + end + 1 != size:
+                f.truncate(position + end + 1)
+            line = tail[:end].rsplit(b"\n", 1)[-1]
+        body, _, digest = line.partition(b"\t")
+        return json.loads(body)["seq"], digest.decode()
+
+    def record(self, action, details=None, wait=False):
+        entry = {
+            "time": datetime.now().isoformat(timespec="microseconds"),
+            "user": self.user,
+            "action": action,
+            "details": details or {},
+        }
+        with self.lock:
+            if self.error is not None:
+                raise RuntimeError(f"audit log writer failed: {self.error}") from self.error
+            if self.closed:
+                raise RuntimeError("audit log is closed")
+            self.enqueued += 1
+            ticket = self.enqueued
+            self.queue.put(entry)
+        if wait:
+            self.wait_for(ticket)
+        return ticket
+
+    def wait_for(self, ticket):
+        with self.written:
+            while self.durable < ticket and self.error is None and self.writer.is_alive():
+                self.written.wait()
+            if self.durable < ticket:
+                raise RuntimeError(f"audit log writer failed: {self.error}") from self.error
+
+    def flush(self):
+        """منتظر ماندن تا همه رکوردهای ثبت‌شده تا این لحظه روی دیسک بنشینند"""
+        with self.lock:
+            ticket = self.enqueued
+        self.wait_for(ticket)
+
+    def write_loop(self):
+        try:
+            self.write_batches()
+        except Exception as e:
+            with self.written:
+                self.error = e
+                self.written.notify_all()
+
+    def write_head(self):
+        temp_path = self.head_path.with_name(self.head_path.name + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"seq": self.seq, "hash": self.last_hash}, f)
+        os.replace(temp_path, self.head_path)
+
+    def write_batches(self):
+        while True:
+            entries = [self.queue.get()]
+            while len(entries) < self.max_batch:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = entries[-1] is None
+            entries = [entry for entry in entries if entry is not None]
+
+            lines = []
+            for entry in entries:
+                self.seq += 1
+                entry["seq"] = self.seq
+                body = json.dumps(entry, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+                self.last_hash = hashlib.sha256(self.last_hash.encode() + body).hexdigest()
+                lines.append(body + b"\t" + self.last_hash.encode() + b"\n")
+            if lines:
+                self.file.write(b"".join(lines))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.write_head()
+            with self.written:
+                self.durable += len(entries)
+                self.written.notify_all()
+            if stop:
+                return
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+        self.writer.join()
+        self.file.close()
+
+def read_audit_head(path):
+    head_path = Path(path).with_name(Path(path).name + ".head")
+    try:
+        with open(head_path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def verify_audit_log(path):
+    """بررسی جریانی زنجیره هش و پیوستگی seq دفتر ممیزی؛ خروجی: (سالم بودن، تعداد رکوردها، آخرین هش، پیام خطا)
+
+    seq باید از ۱ پشت‌سرهم باشد و به seq ثبت‌شده در فایل head برسد؛ در غیر این صورت رکوردهایی حذف شده‌اند.
+    اگر head به آخرین رکورد رسیده باشد هش آن هم باید برابر باشد، وگرنه رکورد آخر با هش بازمحاسبه‌شده جعل شده است.
+    """
+    previous = AUDIT_GENESIS
+    count = 0
+    with open(path, "rb") as f:
+        for number, line in enumerate(f, 1):
+            if not line.endswith(b"\n"):
+                return False, count, previous, f"سطر {number} ناقص است"
+            body, separator, digest = line[:-1].rpartition(b"\t")
+            if not separator:
+                return False, count, previous, f"سطر {number} قالب نامعتبر دارد"
+            expected = hashlib.sha256(previous.encode() + body).hexdigest()
+            if digest.decode() != expected:
+                return False, count, previous, f"زنجیره هش در سطر {number} شکسته است"
+            try:
+                seq = json.loads(body)["seq"]
+            except (ValueError, KeyError):
+                return False, count, previous, f"سطر {number} شماره ترتیب ندارد"
+            if seq != count + 1:
+                return False, count, previous, f"شماره ترتیب سطر {number} پیوسته نیست: {seq} به جای {count + 1}"
+            previous = expected
+            count += 1
+    head = read_audit_head(path)
+    if head is not None and head["seq"] > count:
+        return False, count, previous, f"انتهای دفتر حذف شده است: {head['seq'] - count} رکورد آخر وجود ندارد"
+    if head is not None and head["seq"] == count and head["hash"] != previous:
+        return False, count, previous, "هش آخرین رکورد با فایل head مطابقت ندارد"
+    return True, count, previous, ""
+
+class AlertDispatcher:
+    """اجرای notifierهای هشدار در یک نخ پس‌زمینه تا ثبت گواهی منتظر اعلان یا شبکه نماند
+
+    خطای notifierها به error_handlers (مثلاً نوار وضعیت رابط کاربری) داده می‌شود؛ اگر هیچ handlerی ثبت نشده باشد
+    (مثلاً در خط فرمان) روی stderr چاپ می‌شود.
+    """
+
+    def __init__(self):
+        self.notifiers = []
+        self.error_handlers = []
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def dispatch(self, alert):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, name="alert-dispatcher", daemon=True)
+                self.worker.start()
+        self.queue.put(alert)
+
+    def run(self):
+        while True:
+            alert = self.queue.get()
+            for notifier in list(self.notifiers):
+                try:
+                    notifier(alert)
+                except Exception as e:
+                    self.report(f"خطا در ارسال هشدار: {e}")
+            self.queue.task_done()
+
+    def report(self, message):
+        if not self.error_handlers:
+            print(message, file=sys.stderr)
+        for handler in list(self.error_handlers):
+            handler(message)
+
+    def join(self):
+        """منتظر ماندن تا همه هشدارهای در صف ارسال شوند"""
+        self.queue.join()
+
+class AlertEngine:
+    """ارزیابی افزایشی آستانه‌های هشدار مانده بیمه‌نامه
+
+    آستانه‌ها (مبلغ ریالی یا درصد از ارزش کل) برای یک بیمه‌نامه یا برای همه بیمه‌نامه‌های یک شرکت تعریف می‌شوند
+    و در حافظه نگهداری می‌شوند؛ ارزیابی هر گواهی فقط دو جستجوی دیکشنری است. هشدار فقط هنگام عبور مانده
+    از آستانه ثبت می‌شود، نه در هر گواهی بعدی.
+    """
+
+    def __init__(self, dispatcher=None):
+        self.policy_thresholds = {}
+        self.company_thresholds = {}
+        self.dispatcher = dispatcher if dispatcher is not None else AlertDispatcher()
+
+    def load(self, cursor):
+        cursor.execute('SELECT scope, target, kind, threshold FROM alert_thresholds')
+        self.policy_thresholds.clear()
+        self.company_thresholds.clear()
+        for scope, target, kind, threshold in cursor.fetchall():
+            self.cache_threshold(scope, target, kind, threshold)
+
+    def cache_threshold(self, scope, target, kind, threshold):
+        thresholds = self.policy_thresholds if scope == 'policy' else self.company_thresholds
+        key = int(target) if scope == 'policy' else target
+        if threshold is None:
+            thresholds.pop(key, None)
+        else:
+            thresholds[key] = (kind, threshold)
+
+    def threshold_for(self, policy_id, company_name):
+        return self.policy_thresholds.get(policy_id) or self.company_thresholds.get(company_name)
+
+    @staticmethod
+    def limit_value(kind, threshold, total_value):
+        if kind == 'percent':
+            return total_value * threshold / 100
+        return threshold
+
+    def evaluate(self, cursor, policy_id, company_name, total_value, before, after):
+        """در همان تراکنش تغییر مانده فراخوانی می‌شود و در صورت عبور از آستانه، هشدار را ثبت و برمی‌گرداند"""
+        rule = self.threshold_for(policy_id, company_name)
+        if rule is None:
+            return None
+        kind, threshold = rule
+        limit = self.limit_value(kind, threshold, total_value)
+        if not (before > limit >= after):
+            return None
+        alert = {
+            'policy_id': policy_id,
+            'company_name': company_name,
+            'remaining_value': after,
+            'total_value': total_value,
+            'kind': kind,
+            'threshold': threshold,
+            'created_at': datetime.now().isoformat(timespec="seconds"),
+        }
+        cursor.execute('''
+            INSERT INTO alerts (policy_id, company_name, remaining_value, total_value, kind, threshold, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id
+        ''', (policy_id, company_name, after, total_value, kind, threshold, alert['created_at']))
+        alert['id'] = cursor.fetchone()[0]
+        return alert
+
+    def dispatch(self, alert):
+        self.dispatcher.dispatch(alert)
+
+def format_alert(alert):
+    if alert['kind'] == 'percent':
+        limit = f"{alert['threshold']}%"
+    else:
+        limit = f"{alert['threshold']:,} ریال"
+    return (f"مانده بیمه‌نامه {alert['policy_id']} شرکت {alert['company_name']} "
+            f"به {alert['remaining_value']:,} ریال رسید (آستانه {limit})")
+
+class DesktopNotifier:
+    """نمایش هشدار به صورت اعلان سیستم از طریق آیکون سینی سیستم؛ باید در نخ رابط کاربری فراخوانی شود"""
+
+    def __init__(self, tray_icon):
+        self.tray_icon = tray_icon
+
+    def __call__(self, alert):
+        self.tray_icon.showMessage("هشدار مانده بیمه‌نامه", format_alert(alert))
+
+class WebhookNotifier:
+    """ارسال هشدار به صورت JSON به یک آدرس HTTP (مثلاً سرویس محلی)؛ در نخ AlertDispatcher اجرا می‌شود"""
+
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def __call__(self, alert):
+        request = urllib.request.Request(self.url, data=json.dumps(alert, ensure_ascii=False).encode("utf-8"),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        try:
+            urllib.request.urlopen(request, timeout=self.timeout).close()
+        except OSError as e:
+            raise OSError(f"{self.url}: {e}") from e
+
+class TenantWebhookNotifier:
+    """ارسال هشدار به webhook نمایندگی صادرکننده آن؛ آدرس (تنظیم alert_webhook_url) در هر ارسال از همان نمایندگی خوانده می‌شود"""
+
+    def __init__(self, db_manager, timeout=5):
+        self.db_manager = db_manager
+        self.timeout = timeout
+
+    def __call__(self, alert):
+        url = self.db_manager.get_setting('alert_webhook_url', tenant=alert['tenant'])
+        if url:
+            WebhookNotifier(url, self.timeout)(alert)
+
+DEFAULT_CERTIFICATE_TEMPLATE = """
+        <html dir="rtl">
+        <head>
+            <meta charset="UTF-8">
+            <style>
+                body { font-family: Tahoma, Arial, sans-serif; font-size: 14px; margin: 20px; }
+                .header { border-bottom: 3px solid black; padding-bottom: 10px; margin-bottom: 20px; display: flex; justify-content: space-between; align-items: center; }
+                .info-box { border: 2px solid black; padding: 15px; margin: 10px 0; border-radius: 5px; }
+                .field { display: flex; justify-content: space-between; margin-bottom: 10px; }
+                .label { font-weight: bold; width: 120px; }
+                .value { text-align: right; }
+                .footer { margin-top: 30px; text-align: center; }
+                .signature-area { margin-top: 40px; }
+            </style>
+        </head>
+        <body>
+            <div class="header">
+                <div style="text-align: center; flex: 1;">
+                    <h2>${insurer_name}</h2>
+                    <h3>گواهی حمل بار داخلی/وارداتی</h3>
+                </div>
+                <div style="text-align: center;">
+                    <div style="font-size: 12px; margin-bottom: 5px;">${agency_name}</div>
+                    <div style="font-size: 11px;">کد ${agency_code}</div>
+                </div>
+            </div>
+            
+            <div class="field">
+                <div class="label">شماره سند:</div>
+                <div class="value" style="font-family: Courier New; font-size: 16px;">${sanad_id}</div>
+            </div>
+            <div class="field">
+                <div class="label">تاریخ صدور:</div>
+                <div class="value">${sanad_date}</div>
+            </div>
+            
+            <div class="info-box">
+                <div class="field"><div class="label">نام شرکت:</div><div class="value">${company_name}</div></div>
+                <div class="field"><div class="label">شماره بیمه‌نامه:</div><div class="value">${policy_number}</div></div>
+                <div class="field"><div class="label">تاریخ بیمه‌نامه:</div><div class="value">${policy_date}</div></div>
+                <div class="field"><div class="label">ارزش کل بیمه:</div><div class="value">${total_value} ریال</div></div>
+            </div>
+            
+            <div class="info-box">
+                <div class="field"><div class="label">مبدا و مقصد:</div><div class="value">${route}</div></div>
+                <div class="field"><div class="label">شماره کوتاژها:</div><div class="value">${cottage_numbers}</div></div>
+                <div class="field"><div class="label">تعداد:</div><div class="value">${count}</div></div>
+                <div class="field"><div class="label">ارزش محموله:</div><div class="value" style="font-weight: bold; font-size: 16px;">${value} ریال</div></div>
+            </div>
+            
+            <div style="background: #f0f0f0; padding: 15px; border: 2px solid black; border-radius: 5px; margin-top: 20px;">
+                <div style="display: flex; justify-content: space-between; font-weight: bold;">
+                    <span>مانده اعتبار بیمه‌نامه:</span>
+                    <span>${remaining_after} ریال</span>
+                </div>
+            </div>
+            
+            <div class="footer">
+                <div class="signature-area">
+                    <div style="text-align: center;">
+                        <div>مهر و امضاء بیمه‌گر</div>
+                    </div>
+                </div>
+                <div style="border-top: 1px solid black; padding-top: 10px; font-size: 12px; text-align: center;">
+                    آدرس: ${address} | تلفن: ${phone}
+                </div>
+            </div>
+        </body>
+        </html>
+        """
+
+DEFAULT_TENANT = {
+    "code": "default",
+    "insurer_name": "بیمه سینا",
+    "agency_name": "نمایندگی سهرابی فرد",
+    "agency_code": "6065",
+    "address": "بندرلنگه، مجتمع یاقوت، طبقه اول",
+    "phone": "09173621318",
+    "route": "امارات عربی / بندرلنگه",
+    "db_path": "insurance_system.db",
+    "backend": "sqlite",
+    "dsn": None,
+    "certificate_template": None,
+    "archive_dir": None,
+}
+
+class TenantRegistry:
+    """تنظیمات نمایندگی‌ها (tenant) و قالب گواهی کامپایل‌شده هر نمایندگی
+
+    فایل تنظیمات یک فهرست JSON از نمایندگی‌هاست؛ فیلدهای حذف‌شده از DEFAULT_TENANT گرفته می‌شوند.
+    """
+
+    AGENCY_FIELDS = ("insurer_name", "agency_name", "agency_code", "address", "phone", "route")
+
+    def __init__(self, tenants):
+        self.tenants = {}
+        for tenant in tenants:
+            merged = dict(DEFAULT_TENANT, **tenant)
+            self.tenants[merged["code"]] = merged
+        if not self.tenants:
+            raise ValueError("at least one tenant is required")
+        self.templates = {}
+
+    @classmethod
+    def load(cls, config_path, default_db_path="insurance_system.db"):
+        if config_path and os.path.exists(config_path):
+            with open(config_path, encoding="utf-8") as f:
+                return cls(json.load(f))
+        return cls.single(default_db_path)
+
+    @classmethod
+    def single(cls, db_path):
+        return cls([{"db_path": db_path}])
+
+    def codes(self):
+        return list(self.tenants)
+
+    def get(self, code):
+        return self.tenants[code]
+
+    def archive_directory(self, code):
+        """پوشه بایگانی گواهی‌های نمایندگی
+
+        شماره سندها بین نمایندگی‌ها تکرار می‌شوند، پس هر نمایندگی بایگانی جداگانه دارد: archive_dir در صورت تعیین،
+        وگرنه کنار فایل پایگاه داده SQLite، و برای پشتیبان‌های بدون فایل (PostgreSQL) پوشه‌ای با کد نمایندگی.
+        """
+        tenant = self.tenants[code]
+        if tenant["archive_dir"]:
+            return tenant["archive_dir"]
+        if STORAGE_BACKENDS[tenant["backend"]].file_backed:
+            return CertificateArchive.directory_for(tenant["db_path"])
+        return str(Path("archives") / code)
+
+    def certificate_template(self, code):
+        """قالب گواهی نمایندگی؛ فیلدهای ثابت نمایندگی یک بار جایگذاری و نتیجه کش می‌شود"""
+        template = self.templates.get(code)
+        if template is None:
+            tenant = self.tenants[code]
+            source = DEFAULT_CERTIFICATE_TEMPLATE
+            if tenant["certificate_template"]:
+                with open(tenant["certificate_template"], encoding="utf-8") as f:
+                    source = f.read()
+            agency = {field: tenant[field] for field in self.AGENCY_FIELDS}
+            template = Template(Template(source).safe_substitute(agency))
+            self.templates[code] = template
+        return template
+
+class SQLiteStorage:
+    """پشتیبان پیش‌فرض ذخیره‌سازی روی فایل SQLite
+
+    اتصال‌های باز در یک کش LRU با سقف max_open_connections نگهداری می‌شوند تا تعداد فایل‌های باز محدود بماند؛
+    هر اتصال کش دستورات آماده (prepared statements) خودش را دارد. اتصال‌ها بین نخ‌ها مشترک‌اند و با قفل محافظت می‌شوند.
+    """
+
+    name = "sqlite"
+    file_backed = True
+    lock_clause = ""
+    integrity_error = sqlite3.IntegrityError
+
+    def __init__(self, max_open_connections=32):
+        self.max_open_connections = max(1, max_open_connections)
+        self.connections = OrderedDict()
+        self.lock = threading.RLock()
+
+    def location(self, tenant):
+        return tenant["db_path"]
+
+    def ddl(self, statement):
+        return statement
+
+    def add_column(self, cursor, table, column, definition):
+        """افزودن ستون به جدول پایگاه‌های قدیمی؛ اگر ستون موجود باشد کاری انجام نمی‌شود"""
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    def lock_sanad_ids(self, cursor):
+        """قفل نوشتن پیش از خواندن مانده و MAX(sanad_id)؛ BEGIN IMMEDIATE پردازه‌های دیگر را هم تا commit پشت قفل نگه می‌دارد"""
+        if not cursor.connection.in_transaction:
+            cursor.execute('BEGIN IMMEDIATE')
+
+    def change_log_ddl(self):
+        """تریگرهایی که هر تغییر در مانده بیمه‌نامه یا گواهی‌های آن را در policy_changes ثبت می‌کنند"""
+        return [
+            '''CREATE TRIGGER IF NOT EXISTS policies_inserted AFTER INSERT ON policies
+               BEGIN INSERT INTO policy_changes (policy_id) VALUES (NEW.id); END''',
+            '''CREATE TRIGGER IF NOT EXISTS policies_updated AFTER UPDATE OF total_value, remaining_value ON policies
+               BEGIN INSERT INTO policy_changes (policy_id) VALUES (NEW.id); END''',
+            '''CREATE TRIGGER IF NOT EXISTS certificates_inserted AFTER INSERT ON certificates
+               BEGIN INSERT INTO policy_changes (policy_id) VALUES (NEW.policy_id); END''',
+            '''CREATE TRIGGER IF NOT EXISTS certificates_updated AFTER UPDATE OF policy_id, value, remaining_after ON certificates
+               BEGIN
+                   INSERT INTO policy_changes (policy_id) VALUES (OLD.policy_id);
+                   INSERT INTO policy_changes (policy_id) VALUES (NEW.policy_id);
+               END''',
+            '''CREATE TRIGGER IF NOT EXISTS certificates_deleted AFTER DELETE ON certificates
+               BEGIN INSERT INTO policy_changes (policy_id) VALUES (OLD.policy_id); END''',
+        ]
+
+    def open_connection(self, db_path):
+        conn = self.connections.get(db_path)
+        if conn is not None:
+            self.connections.move_to_end(db_path)
+            return conn
+        while len(self.connections) >= self.max_open_connections:
+            _, evicted = self.connections.popitem(last=False)
+            evicted.close()
+        conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=256)
+        self.connections[db_path] = conn
+        return conn
+
+    @contextmanager
+    def transaction(self, db_path):
+        with self.lock:
+            conn = self.open_connection(db_path)
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def stream(self, conn, query, params=(), batch_size=5000):
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+
+    def discard(self, db_path):
+        with self.lock:
+            conn = self.connections.pop(db_path, None)
+            if conn is not None:
+                conn.close()
+
+    def close(self):
+        with self.lock:
+            while self.connections:
+                _, conn = self.connections.popitem(last=False)
+                conn.close()
+
+class PostgresCursor:
+    """cursor سازگار با sqlite3 روی psycopg: پارامتر ?"""
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    @staticmethod
+    def translate(query):
+        return query.replace('%', '%%').replace('?', '%s')
+
+    def execute(self, query, params=()):
+        self.raw.execute(self.translate(query), params)
+        return self
+
+    def executemany(self, query, params_seq):
+        self.raw.executemany(self.translate(query), params_seq)
+        return self
+
+    def fetchone(self):
+        return self.raw.fetchone()
+
+    def fetchall(self):
+        return self.raw.fetchall()
+
+    def fetchmany(self, size):
+        return self.raw.fetchmany(size)
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    @property
+    def description(self):
+        return self.raw.description
+
+    @property
+    def rowcount(self):
+        return self.raw.rowcount
+
+class PostgresConnection:
+    def __init__(self, raw):
+        self.raw = raw
+
+    def cursor(self):
+        return PostgresCursor(self.raw.cursor())
+
+    def execute(self, query, params=()):
+        return self.cursor().execute(query, params)
+
+class PostgresStorage:
+    """پشتیبان PostgreSQL برای استقرار چندمیزی روی یک سرور مشترک
+
+    هر DSN یک استخر اتصال دارد و هر تراکنش اتصال جداگانه‌ای از استخر می‌گیرد، پس قفل سراسری لازم نیست؛
+    ثبت همزمان گواهی روی یک بیمه‌نامه با SELECT ... FOR UPDATE روی سطر مانده ترتیب‌بندی می‌شود.
+    خواندن‌های حجیم با cursor سمت سرور انجام می‌شوند. نیازمند بسته‌های psycopg و psycopg_pool است.
+    """
+
+    name = "postgresql"
+    file_backed = False
+    lock_clause = " FOR UPDATE"
+    # کلید قفل advisory تخصیص شماره سند
+    SANAD_LOCK_KEY = 0x53414E4144
+
+    def __init__(self, min_connections=1, max_connections=10):
+        import psycopg
+        self.integrity_error = psycopg.IntegrityError
+        self.min_connections = min_connections
+        self.max_connections = max(min_connections, max_connections)
+        self.pools = {}
+        self.cursor_names = itertools.count()
+        self.lock = threading.Lock()
+
+    def location(self, tenant):
+        if not tenant["dsn"]:
+            raise ValueError(f"tenant {tenant['code']} has no PostgreSQL dsn")
+        return tenant["dsn"]
+
+    def ddl(self, statement):
+        # مبالغ ریالی از محدوده INTEGER چهاربایتی PostgreSQL بیشترند
+        return (statement.replace("INTEGER PRIMARY KEY AUTOINCREMENT", "BIGSERIAL PRIMARY KEY")
+                         .replace("INTEGER", "BIGINT"))
+
+    def add_column(self, cursor, table, column, definition):
+        cursor.execute(self.ddl(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}'))
+
+    def lock_sanad_ids(self, cursor):
+        """قفل advisory تا پایان تراکنش؛ ثبت‌های همزمان گواهی شماره سند را به نوبت تخصیص می‌دهند"""
+        cursor.execute('SELECT pg_advisory_xact_lock(?)', (self.SANAD_LOCK_KEY,))
+
+    def change_log_ddl(self):
+        return [
+            '''CREATE OR REPLACE FUNCTION log_policy_change() RETURNS trigger AS $$
+               BEGIN
+                   IF TG_TABLE_NAME = 'policies' THEN
+                       INSERT INTO policy_changes (policy_id) VALUES (NEW.id);
+                   ELSE
+                       IF TG_OP <> 'INSERT' THEN
+                           INSERT INTO policy_changes (policy_id) VALUES (OLD.policy_id);
+                       END IF;
+                       IF TG_OP <> 'DELETE' THEN
+                           INSERT INTO policy_changes (policy_id) VALUES (NEW.policy_id);
+                       END IF;
+                   END IF;
+                   RETURN NULL;
+               END $$ LANGUAGE plpgsql''',
+            'DROP TRIGGER IF EXISTS policies_changed ON policies',
+            '''CREATE TRIGGER policies_changed AFTER INSERT OR UPDATE OF total_value, remaining_value ON policies
+               FOR EACH ROW EXECUTE FUNCTION log_policy_change()''',
+            'DROP TRIGGER IF EXISTS certificates_changed ON certificates',
+            '''CREATE TRIGGER certificates_changed AFTER INSERT OR DELETE OR UPDATE OF policy_id, value, remaining_after
+               ON certificates FOR EACH ROW EXECUTE FUNCTION log_policy_change()''',
+        ]
+
+    def pool(self, dsn):
+        from psycopg_pool import ConnectionPool
+        with self.lock:
+            pool = self.pools.get(dsn)
+            if pool is None:
+                pool = ConnectionPool(dsn, min_size=self.min_connections, max_size=self.max_connections, open=True)
+                self.pools[dsn] = pool
+            return pool
+
+    @contextmanager
+    def transaction(self, dsn):
+        # استخر در پایان بلوک commit و در صورت خطا rollback می‌کند
+        with self.pool(dsn).connection() as conn:
+            yield PostgresConnection(conn)
+
+    def stream(self, conn, query, params=(), batch_size=5000):
+        with conn.raw.cursor(name=f"stream_{next(self.cursor_names)}") as cursor:
+            cursor.itersize = batch_size
+            cursor.execute(PostgresCursor.translate(query), params)
+            yield from cursor
+
+    def discard(self, dsn):
+        with self.lock:
+            pool = self.pools.pop(dsn, None)
+        if pool is not None:
+            pool.close()
+
+    def close(self):
+        with self.lock:
+            pools, self.pools = self.pools, {}
+        for pool in pools.values():
+            pool.close()
+
+STORAGE_BACKENDS = {
+    "sqlite": SQLiteStorage,
+    "postgresql": PostgresStorage,
+}
+
+class ChangeEvent:
+    """تغییر ثبت‌شده در یک جدول: action یکی از 'insert' و 'update'، و برای هر سطر دیکشنری مقادیر جدید (با کلید id)"""
+
+    __slots__ = ("action", "table", "row_ids", "rows")
+
+    def __init__(self, action, table, rows):
+        self.action = action
+        self.table = table
+        self.row_ids = [row['id'] for row in rows]
+        self.rows = rows
+
+    def __repr__(self):
+        return f"ChangeEvent({self.action!r}, {self.table!r}, {self.row_ids!r})"
+
+class ChangeBus:
+    """پخش رویدادهای تغییر داده پس از commit به نماها
+
+    هر مشترک فقط رویدادهای جدول‌های موردنظرش را می‌گیرد و فقط همان سطرها را در مدل خودش اعمال می‌کند.
+    مشترک‌ها در نخ فراخواننده اجرا می‌شوند؛ خطای یک مشترک مانع بقیه نمی‌شود و مانند AlertDispatcher به
+    error_handlers داده می‌شود (بدون handler روی stderr).
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+        self.error_handlers = []
+
+    def subscribe(self, table, callback):
+        self.subscribers.setdefault(table, []).append(callback)
+
+    def emit(self, action, table, rows):
+        callbacks = self.subscribers.get(table)
+        if not callbacks:
+            return
+        event = ChangeEvent(action, table, rows)
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                self.report(f"خطا در بروزرسانی نمای {table}: {e}")
+
+    def report(self, message):
+        if not self.error_handlers:
+            print(message, file=sys.stderr)
+        for handler in list(self.error_handlers):
+            handler(message)
+
+ALLOCATION_STRATEGIES = ("oldest_first", "best_fit", "fewest_policies")
+
+def policy_date_key(policy_date):
+    try:
+        return tuple(int(part) for part in str(policy_date).strip().split('/'))
+    except ValueError:
+        return (float('inf'),)
+
+def allocate_shipment(policies, value, strategy):
+    """تقسیم مبلغ محموله بین بیمه‌نامه‌های باز
+
+    policies: [(id, policy_number, policy_date, total_value, remaining_value)]؛ خروجی [(policy_id, مبلغ)] یا None
+    اگر مجموع مانده‌ها کافی نباشد.
+    oldest_first: به ترتیب تاریخ بیمه‌نامه، با heap روی (تاریخ، id).
+    fewest_policies: بزرگ‌ترین مانده‌ها اول، با heap؛ کمترین تعداد بیمه‌نامه ممکن.
+    best_fit: کوچک‌ترین مانده‌ای که باقی مبلغ را کامل پوشش دهد (جستجوی دودویی روی مانده‌های مرتب)؛ اگر نباشد
+    بزرگ‌ترین مانده مصرف و جستجو تکرار می‌شود تا بیمه‌نامه‌های بزرگ برای محموله‌های بعدی خرد نشوند.
+    """
+    if strategy not in ALLOCATION_STRATEGIES:
+        raise ValueError(f"unknown allocation strategy: {strategy}")
+    policies = [policy for policy in policies if policy[4] > 0]
+    if value <= 0 or sum(policy[4] for policy in policies) < value:
+        return None
+
+    plan = []
+    rest = value
+    if strategy == 'best_fit':
+        balances = sorted((policy[4], policy[0]) for policy in policies)
+        while rest > 0:
+            position = bisect.bisect_left(balances, (rest,))
+            if position < len(balances):
+                plan.append((balances[position][1], rest))
+                break
+            remaining_value, policy_id = balances.pop()
+            plan.append((policy_id, remaining_value))
+            rest -= remaining_value
+        return plan
+
+    if strategy == 'oldest_first':
+        # تاریخ‌های متمایز معمولاً بسیار کمتر از بیمه‌نامه‌ها هستند
+        date_keys = {policy_date: policy_date_key(policy_date) for policy_date in {policy[2] for policy in policies}}
+        heap = [(date_keys[policy[2]], policy[0], policy[4]) for policy in policies]
+    else:
+        heap = [(-policy[4], policy[0], policy[4]) for policy in policies]
+    heapq.heapify(heap)
+    while rest > 0:
+        _, policy_id, remaining_value = heapq.heappop(heap)
+        amount = min(rest, remaining_value)
+        plan.append((policy_id, amount))
+        rest -= amount
+    return plan
+
+def split_count(count, amounts):
+    """تقسیم تعداد بسته‌های محموله به نسبت مبلغ هر بخش با روش بزرگ‌ترین باقیمانده؛ مجموع خروجی همان count است"""
+    total = sum(amounts)
+    if total <= 0:
+        return [count] + [0] * (len(amounts) - 1)
+    shares = [count * amount // total for amount in amounts]
+    order = sorted(range(len(amounts)), key=lambda i: (-(count * amounts[i] % total), i))
+    for i in order[:count - sum(shares)]:
+        shares[i] += 1
+    return shares
+
 class DatabaseManager:
-    def __init__(self, db_path):
-        self.db_path = db_path
+    """دسترسی به پایگاه داده نمایندگی فعال
+
+    هر نمایندگی پایگاه داده جداگانه دارد و نوع آن (backend در تنظیمات نمایندگی) یکی از STORAGE_BACKENDS است؛
+    پیش‌فرض SQLite است. دستورات SQL این کلاس یک بار نوشته شده‌اند و تفاوت‌های هر پشتیبان (مدیریت اتصال، DDL،
+    قفل سطری و cursor سمت سرور) در کلاس پشتیبان است.
+    """
+
+    def __init__(self, db_path=None, audit_log=None, tenants=None, max_open_connections=32, pool_size=10):
+        self.tenants = tenants or TenantRegistry.single(db_path or DEFAULT_TENANT["db_path"])
+        self.tenant = self.tenants.codes()[0]
+        self.audit_log = audit_log
+        self.storage_options = {
+            "sqlite": {"max_open_connections": max_open_connections},
+            "postgresql": {"max_connections": pool_size},
+        }
+        self.storages = {}
+        self.lock = threading.RLock()
+        self.alert_engines = {}
+        self.alert_dispatcher = AlertDispatcher()
+        self.events = ChangeBus()
+        self.initialized = set()
         self.init_database()
 
-    def init_database(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS companies (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE NOT NULL
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS policies (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                company_name TEXT NOT NULL,
-                policy_number TEXT NOT NULL,
-                policy_date TEXT NOT NULL,
-                total_value INTEGER NOT NULL,
-                remaining_value INTEGER NOT NULL,
-                FOREIGN KEY (company_name) REFERENCES companies(name)
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS certificates (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sanad_id INTEGER NOT NULL,
-                sanad_date TEXT NOT NULL,
-                company_name TEXT NOT NULL,
-                policy_id INTEGER NOT NULL,
-                policy_number TEXT NOT NULL,
-                policy_date TEXT NOT NULL,
-                cottage_numbers TEXT NOT NULL,
-                count INTEGER NOT NULL,
-                value INTEGER NOT NULL,
-                remaining_after INTEGER NOT NULL,
-                FOREIGN KEY (company_name) REFERENCES companies(name)
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+    @property
+    def db_path(self):
+        return self.tenants.get(self.tenant)["db_path"]
+
+    def storage_for(self, code):
+        name = self.tenants.get(code)["backend"]
+        storage = self.storages.get(name)
+        if storage is None:
+            if name not in STORAGE_BACKENDS:
+                raise ValueError(f"unknown storage backend: {name}")
+            with self.lock:
+                storage = self.storages.get(name)
+                if storage is None:
+                    storage = STORAGE_BACKENDS[name](**self.storage_options[name])
+                    self.storages[name] = storage
+        return storage
+
+    @property
+    def storage(self):
+        return self.storage_for(self.tenant)
+
+    @property
+    def location(self):
+        return self.storage.location(self.tenants.get(self.tenant))
+
+    @property
+    def file_backed(self):
+        """تحلیل ستونی، بررسی یکپارچگی و پشتیبان‌گیری فایلی فقط برای پایگاه‌های SQLite در دسترس‌اند"""
+        return self.storage.file_backed
+
+    @property
+    def alerts(self):
+        engine = self.alert_engines.get(self.location)
+        if engine is None:
+            engine = AlertEngine(self.alert_dispatcher)
+            self.alert_engines[self.location] = engine
+        return engine
+
+    def use_tenant(self, code):
+        self.tenants.get(code)
+        with self.lock:
+            self.tenant = code
+            self.init_database()
+
+    def certificate_template(self):
+        return self.tenants.certificate_template(self.tenant)
+
+    def connection(self, tenant=None):
+        """اتصال نمایندگی فعال (یا نمایندگی tenant برای کارهای پس‌زمینه)؛ در پایان بلوک commit و در صورت خطا rollback می‌شود"""
+        code = tenant or self.tenant
+        storage = self.storage_for(code)
+        return storage.transaction(storage.location(self.tenants.get(code)))
+
+    def close_connections(self):
+        with self.lock:
+            for storage in self.storages.values():
+                storage.close()
+
+    def audit(self, action, wait=False, tenant=None, **details):
+        """ثبت در دفتر ممیزی پس از commit بدون انتظار برای دیسک؛ نقاط ماندگاری (پشتیبان، بازیابی و خروج) flush می‌کنند"""
+        if self.audit_log is not None:
+            if len(self.tenants.tenants) > 1:
+                details["tenant"] = tenant or self.tenant
+            self.audit_log.record(action, details, wait=wait)
+
+    def init_database(self):
+        if self.location in self.initialized:
+            return
+        ddl = self.storage.ddl
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(ddl('''
+                CREATE TABLE IF NOT EXISTS companies (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT UNIQUE NOT NULL
+                )
+            '''))
+            
+            cursor.execute(ddl('''
+                CREATE TABLE IF NOT EXISTS policies (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    company_name TEXT NOT NULL,
+                    policy_number TEXT NOT NULL,
+                    policy_date TEXT NOT NULL,
+                    total_value INTEGER NOT NULL,
+                    remaining_value INTEGER NOT NULL,
+                    FOREIGN KEY (company_name) REFERENCES companies(name)
+                )
+            '''))
+            
+            cursor.execute(ddl('''
+                CREATE TABLE IF NOT EXISTS certificates (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sanad_id INTEGER NOT NULL,
+                    sanad_date TEXT NOT NULL,
+                    company_name TEXT NOT NULL,
+                    policy_id INTEGER NOT NULL,
+                    policy_number TEXT NOT NULL,
+                    policy_date TEXT NOT NULL,
+                    cottage_numbers TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    value INTEGER NOT NULL,
+                    remaining_after INTEGER NOT NULL,
+                    sanad_date_key INTEGER,
+                    FOREIGN KEY (company_name) REFERENCES companies(name)
+                )
+            '''))
+            
+            # تاریخ سند به صورت عدد YYYYMMDD هنگام ثبت نوشته می‌شود تا فیلتر پنجره تحلیل جستجوی بازه‌ای روی ایندکس باشد؛
+            # برای پایگاه‌های قدیمی و سطرهایی که خارج از برنامه درج شده‌اند در همین‌جا پر می‌شود
+            self.storage.add_column(cursor, 'certificates', 'sanad_date_key', 'INTEGER')
+            self.fill_sanad_date_keys(cursor)
+            cursor.execute('DROP INDEX IF EXISTS idx_certificates_date')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_certificates_date_key ON certificates (sanad_date_key, policy_id, value)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_certificates_policy ON certificates (policy_id)')
+            # پایگاه‌های قدیمی ممکن است شماره سند تکراری داشته باشند؛ در آن صورت ایندکس غیریکتا می‌ماند
+            # و بررسی یکپارچگی تکرارها را گزارش می‌کند
+            cursor.execute('SAVEPOINT sanad_unique')
+            try:
+                cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_certificates_sanad_unique ON certificates (sanad_id)')
+            except self.storage.integrity_error:
+                cursor.execute('ROLLBACK TO SAVEPOINT sanad_unique')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_certificates_sanad ON certificates (sanad_id)')
+            else:
+                cursor.execute('DROP INDEX IF EXISTS idx_certificates_sanad')
+            cursor.execute('RELEASE SAVEPOINT sanad_unique')
+            
+            cursor.execute(ddl('''
+                CREATE TABLE IF NOT EXISTS certificate_links (
+                    certificate_id INTEGER PRIMARY KEY,
+                    allocation_id INTEGER NOT NULL
+                )
+            '''))
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_certificate_links_allocation ON certificate_links (allocation_id)')
+            
+            # دفتر تغییرات بیمه‌نامه‌ها برای بررسی افزایشی یکپارچگی؛ توسط تریگر پر می‌شود تا تغییرات خارج از برنامه هم ثبت شوند
+            cursor.execute(ddl('''
+                CREATE TABLE IF NOT EXISTS policy_changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    policy_id INTEGER NOT NULL
+                )
+            '''))
+            for statement in self.storage.change_log_ddl():
+                cursor.execute(statement)
+            
+            cursor.execute(ddl('''
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            '''))
+            
+            cursor.execute(ddl('''
+                CREATE TABLE IF NOT EXISTS alert_thresholds (
+                    scope TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    threshold INTEGER NOT NULL,
+                    PRIMARY KEY (scope, target)
+                )
+            '''))
+            
+            cursor.execute(ddl('''
+                CREATE TABLE IF NOT EXISTS alerts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    policy_id INTEGER NOT NULL,
+                    company_name TEXT NOT NULL,
+                    remaining_value INTEGER NOT NULL,
+                    total_value INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    threshold INTEGER NOT NULL,
+                    created_at TEXT NOT NULL,
+                    acknowledged INTEGER NOT NULL DEFAULT 0
+                )
+            '''))
+            
+            self.alerts.load(cursor)
+        self.initialized.add(self.location)
+
+    @staticmethod
+    def fill_sanad_date_keys(cursor):
+        cursor.execute('SELECT id, sanad_date FROM certificates WHERE sanad_date_key IS NULL')
+        rows = cursor.fetchall()
+        if rows:
+            key = lru_cache(maxsize=4096)(jalali_date_key)
+            cursor.executemany('UPDATE certificates SET sanad_date_key = ? WHERE id = ?',
+                               [(key(sanad_date), certificate_id) for certificate_id, sanad_date in rows])
+
+    def reload(self):
+        """پس از جایگزینی فایل پایگاه داده (بازیابی پشتیبان) اتصال و کش هشدارها از نو ساخته می‌شوند"""
+        with self.lock:
+            self.storage.discard(self.location)
+            self.alert_engines.pop(self.location, None)
+            self.initialized.discard(self.location)
+            self.init_database()
+
+    def get_next_sanad_id(self):
+        """فقط برای نمایش؛ شماره قطعی هنگام ثبت و داخل تراکنش تخصیص داده می‌شود"""
+        with self.connection() as conn:
+            return self.next_sanad_id(conn.cursor())
+
+    @staticmethod
+    def next_sanad_id(cursor):
+        cursor.execute('SELECT MAX(sanad_id) FROM certificates')
+        return (cursor.fetchone()[0] or 3999) + 1
+
+    def add_company(self, name):
+        try:
+            with self.connection() as conn:
+                company_id = conn.execute('INSERT INTO companies (name) VALUES (?) RETURNING id', (name,)).fetchone()[0]
+        except self.storage.integrity_error:
+            return False
+        self.audit('add_company', name=name)
+        self.events.emit('insert', 'companies', [{'id': company_id, 'name': name}])
+        return True
+
+    def get_companies(self):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT name FROM companies ORDER BY name')
+            return [row[0] for row in cursor.fetchall()]
+
+    def add_policy(self, company_name, policy_number, policy_date, total_value):
+        try:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO policies (company_name, policy_number, policy_date, total_value, remaining_value)
+                    VALUES (?, ?, ?, ?, ?) RETURNING id
+                ''', (company_name, policy_number, policy_date, total_value, total_value))
+                policy_id = cursor.fetchone()[0]
+        except self.storage.integrity_error:
+            return False
+        self.audit('add_policy', policy_id=policy_id, company_name=company_name,
+                   policy_number=policy_number, policy_date=policy_date, total_value=total_value)
+        self.events.emit('insert', 'policies', [{'id': policy_id, 'company_name': company_name, 'policy_number': policy_number,
+                                                 'policy_date': policy_date, 'total_value': total_value,
+                                                 'remaining_value': total_value}])
+        return policy_id
+
+    def get_policies(self, company_name=None):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            if company_name:
+                cursor.execute('''
+                    SELECT id, policy_number, policy_date, total_value, remaining_value 
+                    FROM policies WHERE company_name = ? AND remaining_value > 0
+                    ORDER BY policy_number
+                ''', (company_name,))
+                return cursor.fetchall()
+            return list(self.storage.stream(conn, 'SELECT id, company_name, policy_number, policy_date, total_value, remaining_value '
+                                                  'FROM policies ORDER BY company_name, policy_number'))
+
+    def check_cottage_exists(self, cottage_numbers):
+        if not cottage_numbers:
+            return []
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT sanad_id FROM certificates WHERE cottage_numbers LIKE ? OR cottage_numbers LIKE ?',
+                           (f'%{cottage_numbers}%', f'%{cottage_numbers.split("-")[0]}%'))
+            return [row[0] for row in cursor.fetchall()]
+
+    def add_certificate(self, sanad_id, sanad_date, company_name, policy_id, policy_number, policy_date, cottage_numbers, count, value):
+        """ثبت یک گواهی؛ اگر sanad_id برابر None باشد شماره سند داخل همین تراکنش و زیر قفل تخصیص داده می‌شود
+
+        خروجی: (موفقیت، گواهی ثبت‌شده شامل sanad_id و remaining_after یا None)
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            self.storage.lock_sanad_ids(cursor)
+            
+            cursor.execute('SELECT remaining_value, total_value FROM policies WHERE id = ?' + self.storage.lock_clause, (policy_id,))
+            current_remaining, total_value = cursor.fetchone()
+            
+            if value > current_remaining:
+                return False, None
+            
+            if sanad_id is None:
+                sanad_id = self.next_sanad_id(cursor)
+            
+            certificate = {'sanad_id': sanad_id, 'sanad_date': sanad_date, 'company_name': company_name,
+                           'policy_id': policy_id, 'policy_number': policy_number, 'policy_date': policy_date,
+                           'cottage_numbers': cottage_numbers, 'count': count, 'value': value}
+            alert = self.insert_certificate(cursor, certificate, current_remaining, total_value)
+        
+        self.publish_certificates([certificate], [alert] if alert else [])
+        return True, certificate
+
+    def add_allocated_certificates(self, sanad_date, company_name, cottage_numbers, count, value, strategy):
+        """تقسیم یک محموله بین بیمه‌نامه‌های باز شرکت با روش strategy و صدور گواهی‌های مرتبط در یک تراکنش
+
+        برنامه تخصیص داخل همان تراکنش و پس از قفل سطرهای بیمه‌نامه‌ها محاسبه می‌شود، پس ثبت همزمان دیگری
+        نمی‌تواند مانده‌ها را بین محاسبه و ثبت تغییر دهد. گواهی‌ها شماره سند پشت‌سرهم می‌گیرند و در جدول
+        certificate_links با شناسه اولین گواهی به هم مرتبط می‌شوند. شماره کوتاژها در همه گواهی‌ها تکرار می‌شود
+        اما تعداد به نسبت مبلغ بین آن‌ها تقسیم می‌شود تا جمع تعداد گواهی‌ها با محموله برابر بماند.
+        خروجی: (موفقیت، فهرست گواهی‌های صادرشده)
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            self.storage.lock_sanad_ids(cursor)
+            cursor.execute('''
+                SELECT id, policy_number, policy_date, total_value, remaining_value
+                FROM policies WHERE company_name = ? AND remaining_value > 0
+            ''' + self.storage.lock_clause, (company_name,))
+            policies = {row[0]: row for row in cursor.fetchall()}
+            plan = allocate_shipment(policies.values(), value, strategy)
+            if plan is None:
+                return False, []
+
+            next_sanad_id = self.next_sanad_id(cursor)
+            counts = split_count(count, [amount for _, amount in plan])
+            certificates = []
+            alerts = []
+            for offset, (policy_id, amount) in enumerate(plan):
+                _, policy_number, policy_date, total_value, remaining_value = policies[policy_id]
+                certificate = {'sanad_id': next_sanad_id + offset, 'sanad_date': sanad_date, 'company_name': company_name,
+                               'policy_id': policy_id, 'policy_number': policy_number, 'policy_date': policy_date,
+                               'cottage_numbers': cottage_numbers, 'count': counts[offset], 'value': amount,
+                               'total_value': total_value}
+                alert = self.insert_certificate(cursor, certificate, remaining_value, total_value)
+                if alert:
+                    alerts.append(alert)
+                certificates.append(certificate)
+            allocation_id = certificates[0]['id']
+            cursor.executemany('INSERT INTO certificate_links (certificate_id, allocation_id) VALUES (?, ?)',
+                               [(certificate['id'], allocation_id) for certificate in certificates])
+
+        for certificate in certificates:
+            certificate['allocation_id'] = allocation_id
+        self.publish_certificates(certificates, alerts)
+        return True, certificates
+
+    def insert_certificate(self, cursor, certificate, current_remaining, total_value):
+        """کسر مانده و ثبت گواهی در تراکنش جاری؛ id و remaining_after به certificate افزوده و هشدار احتمالی برگردانده می‌شود"""
+        remaining_after = current_remaining - certificate['value']
+        certificate['remaining_after'] = remaining_after
+        
+        cursor.execute('''
+            UPDATE policies SET remaining_value = remaining_value - ? WHERE id = ?
+        ''', (certificate['value'], certificate['policy_id']))
+        
+        cursor.execute('''
+            INSERT INTO certificates (sanad_id, sanad_date, company_name, policy_id, policy_number, policy_date, cottage_numbers, count, value, remaining_after, sanad_date_key)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) RETURNING id
+        ''', (certificate['sanad_id'], certificate['sanad_date'], certificate['company_name'], certificate['policy_id'],
+              certificate['policy_number'], certificate['policy_date'], certificate['cottage_numbers'], certificate['count'],
+              certificate['value'], remaining_after, jalali_date_key(certificate['sanad_date'])))
+        certificate['id'] = cursor.fetchone()[0]
+        return self.alerts.evaluate(cursor, certificate['policy_id'], certificate['company_name'], total_value,
+                                    current_remaining, remaining_after)
+
+    def publish_certificates(self, certificates, alerts):
+        """پس از commit: ارسال هشدارها، ثبت در دفتر ممیزی و انتشار رویدادهای تغییر"""
+        for alert in alerts:
+            alert['tenant'] = self.tenant
+            self.alerts.dispatch(alert)
+        for certificate in certificates:
+            details = {key: certificate[key] for key in ('sanad_id', 'sanad_date', 'company_name', 'policy_id',
+                                                         'cottage_numbers', 'count', 'value', 'remaining_after')}
+            if 'allocation_id' in certificate:
+                details['allocation_id'] = certificate['allocation_id']
+            self.audit('add_certificate', certificate_id=certificate['id'], **details)
+        self.events.emit('update', 'policies', [{'id': certificate['policy_id'], 'company_name': certificate['company_name'],
+                                                 'remaining_value': certificate['remaining_after']}
+                                                for certificate in certificates])
+        self.events.emit('insert', 'certificates', [
+            {key: certificate[key] for key in ('id', 'sanad_id', 'sanad_date', 'company_name', 'policy_id', 'policy_number',
+                                               'cottage_numbers', 'count', 'value', 'remaining_after')}
+            for certificate in certificates])
+        if alerts:
+            self.events.emit('insert', 'alerts', alerts)
+
+    def set_alert_threshold(self, scope, target, kind, threshold):
+        """scope: 'company' یا 'policy'؛ kind: 'amount' یا 'percent'؛ threshold=None آستانه را حذف می‌کند"""
+        if scope not in ('company', 'policy') or kind not in ('amount', 'percent'):
+            raise ValueError("invalid alert threshold")
+        with self.connection() as conn:
+            if threshold is None:
+                conn.execute('DELETE FROM alert_thresholds WHERE scope = ? AND target = ?', (scope, str(target)))
+            else:
+                conn.execute('INSERT INTO alert_thresholds (scope, target, kind, threshold) VALUES (?, ?, ?, ?) '
+                             'ON CONFLICT (scope, target) DO UPDATE SET kind = excluded.kind, threshold = excluded.threshold',
+                             (scope, str(target), kind, threshold))
+        self.alerts.cache_threshold(scope, str(target), kind, threshold)
+        self.audit('set_alert_threshold', scope=scope, target=str(target), kind=kind, threshold=threshold)
+
+    def get_alerts(self, include_acknowledged=False):
+        query = 'SELECT * FROM alerts'
+        if not include_acknowledged:
+            query += ' WHERE acknowledged = 0'
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query + ' ORDER BY id')
+            columns = [description[0] for description in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def acknowledge_alerts(self):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE alerts SET acknowledged = 1 WHERE acknowledged = 0')
+            count = cursor.rowcount
+        self.audit('acknowledge_alerts', count=count)
+        return count
+
+    def get_setting(self, key, default=None, tenant=None):
+        with self.connection(tenant) as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
+            row = cursor.fetchone()
+        return row[0] if row else default
+
+    def set_setting(self, key, value, tenant=None):
+        with self.connection(tenant) as conn:
+            conn.execute('INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+                         (key, str(value)))
+        self.audit('set_setting', tenant=tenant, key=key, value=str(value))
+
+def jalali_to_ordinal(date_text):
+    """تبدیل تاریخ شمسی (YYYY/MM/DD) به شماره روز میلادی؛ در صورت نامعتبر بودن -1"""
+    from jdatetime import date as jdate
+    try:
+        year, month, day = (int(part) for part in str(date_text).strip().split('/'))
+        return jdate(year, month, day).togregorian().toordinal()
+    except (ValueError, TypeError):
+        return -1
+
+def jalali_date_key(date_text):
+    """کلید عددی YYYYMMDD برای تاریخ شمسی با یا بدون صفر پیشرو (1404/1/5 → 14040105)؛ در صورت نامعتبر بودن -1"""
+    try:
+        year, month, day = (int(part) for part in str(date_text).strip().split('/'))
+    except (ValueError, TypeError):
+        return -1
+    if year < 1 or not 1 <= month <= 12 or not 1 <= day <= 31:
+        return -1
+    return year * 10000 + month * 100 + day
+
+def register_jalali_key(conn):
+    """ثبت تابع SQL با نام jalali_key روی اتصال SQLite؛ تاریخ‌های تکراری فقط یک بار تجزیه می‌شوند"""
+    conn.create_function('jalali_key', 1, lru_cache(maxsize=4096)(jalali_date_key), deterministic=True)
+    return conn
+
+def ordinal_to_jalali(ordinal):
+    from jdatetime import date as jdate
+    return jdate.fromgregorian(date=date.fromordinal(int(ordinal))).strftime("%Y/%m/%d")
+
+class ColumnarSnapshot:
+    """کش ستونی و memory-mapped از ستون‌های عددی و تاریخ جداول certificates و policies
+
+    هر ستون در یک فایل int64 جدا ذخیره می‌شود و بروزرسانی از آخرین id خوانده‌شده (high-water mark) انجام می‌شود.
+    تاریخ‌ها به صورت عدد YYYYMMDD نگهداری می‌شوند و تاریخ نامعتبر -1 ذخیره می‌شود.
+    بروزرسانی در نخ پس‌زمینه انجام می‌شود؛ بروزرسانی‌های همزمان با قفل پشت سر هم اجرا می‌شوند و پاک‌کردن کش
+    از نخ رابط کاربری با request_clear به اولین بروزرسانی بعدی سپرده می‌شود.
+    """
+
+    # با تغییر نحوه ذخیره ستون‌ها افزایش می‌یابد تا کش قدیمی دور ریخته شود
+    FORMAT = 2
+
+    TABLES = {
+        'certificates': [
+            ('id', 'id'),
+            ('sanad_id', 'sanad_id'),
+            ('sanad_date', 'COALESCE(sanad_date_key, jalali_key(sanad_date))'),
+            ('policy_id', 'policy_id'),
+            ('count', 'count'),
+            ('value', 'value'),
+            ('remaining_after', 'remaining_after'),
+        ],
+        'policies': [
+            ('id', 'id'),
+            ('policy_date', 'jalali_key(policy_date)'),
+            ('total_value', 'total_value'),
+            ('remaining_value', 'remaining_value'),
+        ],
+    }
+
+    def __init__(self, db_path, directory):
+        self.db_path = db_path
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.meta = self.load_meta()
+        self.lock = threading.Lock()
+        self.clear_requested = False
+
+    def column_path(self, table, column):
+        return self.directory / f"{table}.{column}.i8"
+
+    def load_meta(self):
+        meta_path = self.directory / "meta.json"
+        if meta_path.exists():
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get('format') == self.FORMAT:
+                return meta
+        return self.empty_meta()
+
+    def empty_meta(self):
+        return {'format': self.FORMAT,
+                'certificates': {'rows': 0, 'last_id': 0, 'last_value': None},
+                'policies': {'rows': 0, 'last_id': 0}}
+
+    def save_meta(self, meta):
+        meta_path = self.directory / "meta.json"
+        temp_path = self.directory / "meta.json.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(temp_path, meta_path)
+
+    def clear(self):
+        """حذف کامل کش؛ مثلاً پس از بازیابی پایگاه داده"""
+        for table, columns in self.TABLES.items():
+            for column, _ in columns:
+                path = self.column_path(table, column)
+                if path.exists():
+                    path.unlink()
+        meta = self.empty_meta()
+        self.save_meta(meta)
+        self.meta = meta
+
+    def request_clear(self):
+        """پاک‌کردن کش در اولین بروزرسانی بعدی، بدون منتظر ماندن برای بروزرسانی در حال اجرا"""
+        self.clear_requested = True
+
+    def append_rows(self, table, rows, meta):
+        import numpy as np
+        block = np.array(rows, dtype=np.int64)
+        for position, (column, _) in enumerate(self.TABLES[table]):
+            with open(self.column_path(table, column), "ab") as f:
+                f.write(np.ascontiguousarray(block[:, position]).tobytes())
+        meta[table]['rows'] += len(block)
+        meta[table]['last_id'] = int(block[-1, 0])
+        return block
+
+    def truncate_to_meta(self, table):
+        # بایت‌های اضافه ناشی از بروزرسانی نیمه‌تمام قبلی حذف می‌شوند
+        size = self.meta[table]['rows'] * 8
+        for column, _ in self.TABLES[table]:
+            path = self.column_path(table, column)
+            if path.exists() and path.stat().st_size != size:
+                with open(path, "r+b") as f:
+                    f.truncate(size)
+
+    def is_stale(self, cursor):
+        last = self.meta['certificates']
+        if not last['last_id']:
+            return False
+        cursor.execute('SELECT value FROM certificates WHERE id = ?', (last['last_id'],))
+        row = cursor.fetchone()
+        return row is None or row[0] != last['last_value']
+
+    def refresh(self):
+        """افزودن سطرهای جدید از آخرین id و بروزرسانی مانده بیمه‌نامه‌های تغییرکرده؛ تعداد سطرهای جدید گواهی برگردانده می‌شود
+
+        متادیتای جدید روی یک کپی ساخته و ابتدا روی دیسک ذخیره می‌شود و فقط پس از آن جایگزین self.meta می‌شود،
+        پس خطا در میانه کار نه متادیتای حافظه و نه فایل را از ستون‌ها جلوتر نمی‌برد.
+        """
+        with self.lock:
+            if self.clear_requested:
+                self.clear_requested = False
+                self.clear()
+            return self.append_new_rows()
+
+    def append_new_rows(self):
+        import numpy as np
+        conn = register_jalali_key(sqlite3.connect(self.db_path))
+        cursor = conn.cursor()
+        if self.is_stale(cursor):
+            self.clear()
+        for table in self.TABLES:
+            self.truncate_to_meta(table)
+
+        meta = copy.deepcopy(self.meta)
+        added = 0
+        touched = set()
+        expressions = ', '.join(expression for _, expression in self.TABLES['certificates'])
+        cursor.execute(f'SELECT {expressions} FROM certificates WHERE id > ? ORDER BY id',
+                       (meta['certificates']['last_id'],))
+        while True:
+            rows = cursor.fetchmany(100000)
+            if not rows:
+                break
+            block = self.append_rows('certificates', rows, meta)
+            touched.update(np.unique(block[:, 3]).tolist())
+            meta['certificates']['last_value'] = int(block[-1, 5])
+            added += len(block)
+
+        expressions = ', '.join(expression for _, expression in self.TABLES['policies'])
+        cursor.execute(f'SELECT {expressions} FROM policies WHERE id > ? ORDER BY id',
+                       (meta['policies']['last_id'],))
+        rows = cursor.fetchall()
+        if rows:
+            self.append_rows('policies', rows, meta)
+
+        if touched:
+            ids = self.column('policies', 'id', meta=meta)
+            remaining = self.column('policies', 'remaining_value', writable=True, meta=meta)
+            touched = sorted(touched)
+            for start in range(0, len(touched), 900):
+                batch = touched[start:start + 900]
+                placeholders = ','.join('?' * len(batch))
+                cursor.execute(f'SELECT id, remaining_value FROM policies WHERE id IN ({placeholders})', batch)
+                updates = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 2)
+                positions = np.searchsorted(ids, updates[:, 0])
+                remaining[positions] = updates[:, 1]
+            if len(remaining):
+                remaining.flush()
+        conn.close()
+        self.save_meta(meta)
+        self.meta = meta
+        return added
+
+    def column(self, table, column, writable=False, meta=None):
+        """نمای memory-mapped و بدون کپی از یک ستون"""
+        import numpy as np
+        rows = (meta or self.meta)[table]['rows']
+        if rows == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.memmap(self.column_path(table, column), dtype=np.int64,
+                         mode="r+" if writable else "r", shape=(rows,))
+
+class CertificateArchive:
+    """بایگانی محتوا-محور گواهی‌های چاپ‌شده
+
+    هر گواهی به دو بخش head (سبک‌ها و بخش ثابت تا <body>) و body تقسیم می‌شود. هر بخش با هش sha256 محتوایش
+    فقط یک بار در فایل بسته‌ای certificates.pack ذخیره می‌شود، بنابراین head مشترک همه گواهی‌ها تکرار نمی‌شود.
+    body با zlib و با اولین body هم‌head به عنوان دیکشنری فشرده می‌شود. فهرست‌ها در archive.db نگهداری می‌شوند
+    و خواندن از فایل بسته‌ای از طریق mmap انجام می‌شود.
+    """
+
+    SPLIT_MARKER = "<body>"
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.pack_path = self.directory / "certificates.pack"
+        self.pack_path.touch(exist_ok=True)
+        self.pack = open(self.pack_path, "ab")
+        self.mapped = None
+        self.mapped_size = 0
+        self.objects = {}
+        self.head_dictionaries = {}
+        self.plain_cache = {}
+        self.conn = sqlite3.connect(str(self.directory / "archive.db"))
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS objects (
+                hash TEXT PRIMARY KEY,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                dictionary TEXT
+            );
+            CREATE TABLE IF NOT EXISTS heads (
+                hash TEXT PRIMARY KEY,
+                dictionary TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sanad_id INTEGER NOT NULL,
+                head_hash TEXT NOT NULL,
+                body_hash TEXT NOT NULL,
+                archived_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_documents_sanad ON documents (sanad_id);
+        ''')
+        for hash_, offset, length, dictionary in self.conn.execute('SELECT hash, offset, length, dictionary FROM objects'):
+            self.objects[hash_] = (offset, length, dictionary)
+        self.head_dictionaries = dict(self.conn.execute('SELECT hash, dictionary FROM heads'))
+
+    @staticmethod
+    def directory_for(db_path):
+        """پوشه بایگانی کنار فایل پایگاه داده (یا فایل پشتیبان)"""
+        return f"{Path(db_path).with_suffix('')}_archive"
+
+    def close(self):
+        self.pack.close()
+        if self.mapped is not None:
+            self.mapped.close()
+        self.conn.close()
+
+    def backup_to(self, directory):
+        """نسخه سازگار بایگانی در directory؛ فهرست پیش از فایل بسته‌ای کپی می‌شود چون فایل بسته‌ای فقط بزرگ می‌شود"""
+        target = Path(directory)
+        if target.exists():
+            shutil.rmtree(target)
+        target.mkdir(parents=True)
+        backup_conn = sqlite3.connect(str(target / "archive.db"))
+        with backup_conn:
+            self.conn.backup(backup_conn)
+        backup_conn.close()
+        self.pack.flush()
+        shutil.copy2(self.pack_path, target / "certificates.pack")
+
+    def retain_issued(self, db_path):
+        """حذف اسناد بایگانی‌شده‌ای که گواهی آن‌ها در پایگاه داده (مثلاً پس از بازیابی پشتیبان) وجود ندارد"""
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        sanad_ids = conn.execute('SELECT DISTINCT sanad_id FROM certificates').fetchall()
+        conn.close()
+        with self.conn:
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS issued (sanad_id INTEGER PRIMARY KEY)')
+            self.conn.execute('DELETE FROM temp.issued')
+            self.conn.executemany('INSERT INTO temp.issued (sanad_id) VALUES (?)', sanad_ids)
+            removed = self.conn.execute('DELETE FROM documents WHERE sanad_id NOT IN (SELECT sanad_id FROM temp.issued)').rowcount
+            self.conn.execute('DROP TABLE temp.issued')
+        return removed
+
+    def split(self, html):
+        position = html.find(self.SPLIT_MARKER)
+        if position == -1:
+            return "", html
+        position += len(self.SPLIT_MARKER)
+        return html[:position], html[position:]
+
+    def put_object(self, data, pending, dictionary=None):
+        """نوشتن شیء در فایل بسته‌ای؛ محل آن فقط در pending ثبت می‌شود تا پس از commit فهرست به self.objects برسد"""
+        hash_ = hashlib.sha256(data).hexdigest()
+        if hash_ in self.objects or hash_ in pending:
+            return hash_
+        if dictionary is not None:
+            compressor = zlib.compressobj(9, zdict=self.read_object(dictionary, pending))
+        else:
+            compressor = zlib.compressobj(9)
+        compressed = compressor.compress(data) + compressor.flush()
+        offset = self.pack.tell()
+        self.pack.write(compressed)
+        pending[hash_] = (offset, len(compressed), dictionary)
+        return hash_
+
+    def store_many(self, documents):
+        """بایگانی دسته‌ای [(sanad_id, html)] در یک تراکنش
+
+        کش‌های حافظه (objects و head_dictionaries) فقط پس از commit موفق فهرست بروزرسانی می‌شوند؛ اگر commit شکست
+        بخورد بایت‌های نوشته‌شده در فایل بسته‌ای بی‌ارجاع می‌مانند و به آن‌ها اشاره‌ای نمی‌شود.
+        """
+        pending = {}
+        new_heads = {}
+        rows = []
+        archived_at = datetime.now().isoformat(timespec="seconds")
+        for sanad_id, html in documents:
+            head, body = self.split(html)
+            head_hash = self.put_object(head.encode("utf-8"), pending)
+            dictionary = self.head_dictionaries.get(head_hash) or new_heads.get(head_hash)
+            body_hash = self.put_object(body.encode("utf-8"), pending, dictionary)
+            if dictionary is None:
+                # اولین body هر head دیکشنری فشرده‌سازی bodyهای بعدی می‌شود
+                new_heads[head_hash] = body_hash
+            rows.append((sanad_id, head_hash, body_hash, archived_at))
+        # داده‌ها پیش از فهرست روی دیسک نوشته می‌شوند تا فهرست هرگز به بایت ناموجود اشاره نکند
+        self.pack.flush()
+        os.fsync(self.pack.fileno())
+        with self.conn:
+            self.conn.executemany('INSERT INTO objects (hash, offset, length, dictionary) VALUES (?, ?, ?, ?)',
+                                  [(hash_, *location) for hash_, location in pending.items()])
+            self.conn.executemany('INSERT INTO heads (hash, dictionary) VALUES (?, ?)', new_heads.items())
+            self.conn.executemany('INSERT INTO documents (sanad_id, head_hash, body_hash, archived_at) VALUES (?, ?, ?, ?)', rows)
+        self.objects.update(pending)
+        self.head_dictionaries.update(new_heads)
+
+    def store(self, sanad_id, html):
+        self.store_many([(sanad_id, html)])
+
+    def view(self, offset, length):
+        if offset + length > self.mapped_size:
+            self.pack.flush()
+            if self.mapped is not None:
+                self.mapped.close()
+            with open(self.pack_path, "rb") as f:
+                self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped_size = len(self.mapped)
+        return memoryview(self.mapped)[offset:offset + length]
+
+    def read_object(self, hash_, pending=None):
+        data = self.plain_cache.get(hash_)
+        if data is not None:
+            return data
+        location = self.objects.get(hash_)
+        if location is None:
+            location = pending[hash_]
+        offset, length, dictionary = location
+        if dictionary is not None:
+            decompressor = zlib.decompressobj(zdict=self.read_object(dictionary, pending))
+        else:
+            decompressor = zlib.decompressobj()
+        data = decompressor.decompress(self.view(offset, length)) + decompressor.flush()
+        if dictionary is None and len(self.plain_cache) < 256:
+            # headها و دیکشنری‌ها مشترک‌اند و در حافظه نگه داشته می‌شوند
+            self.plain_cache[hash_] = data
+        return data
+
+    def document(self, head_hash, body_hash):
+        return (self.read_object(head_hash) + self.read_object(body_hash)).decode("utf-8")
+
+    def get(self, sanad_id):
+        """آخرین نسخه بایگانی‌شده گواهی یا None"""
+        row = self.conn.execute('SELECT head_hash, body_hash FROM documents WHERE sanad_id = ? ORDER BY id DESC LIMIT 1',
+                                (sanad_id,)).fetchone()
+        return self.document(*row) if row else None
+
+    def get_many(self, sanad_ids=None):
+        """بازیابی دسته‌ای به صورت (sanad_id, html) به ترتیب محل ذخیره در فایل بسته‌ای"""
+        query = 'SELECT sanad_id, head_hash, body_hash FROM documents'
+        if sanad_ids is None:
+            cursor = self.conn.execute(query + ' ORDER BY id')
+            for sanad_id, head_hash, body_hash in cursor:
+                yield sanad_id, self.document(head_hash, body_hash)
+            return
+        sanad_ids = list(sanad_ids)
+        for start in range(0, len(sanad_ids), 900):
+            batch = sanad_ids[start:start + 900]
+            placeholders = ','.join('?' * len(batch))
+            cursor = self.conn.execute(query + f' WHERE sanad_id IN ({placeholders}) ORDER BY id', batch)
+            for sanad_id, head_hash, body_hash in cursor:
+                yield sanad_id, self.document(head_hash, body_hash)
+
+class PolicyAnalytics:
+    """تحلیل نرخ مصرف بیمه‌نامه‌ها و پیش‌بینی تاریخ اتمام مانده به صورت برداری"""
+
+    def __init__(self, db_path, window_days=30, snapshot=None):
+        self.db_path = db_path
+        self.window_days = window_days
+        self.snapshot = snapshot
+
+    def load_series(self, since_date=None):
+        """بارگذاری یکباره بیمه‌نامه‌ها و سری زمانی مصرف آن‌ها (از تاریخ since_date به بعد) در آرایه‌های NumPy"""
+        import numpy as np
+        conn = register_jalali_key(sqlite3.connect(self.db_path))
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, company_name, policy_number, policy_date, total_value, remaining_value FROM policies ORDER BY id')
+        policies = cursor.fetchall()
+
+        if self.snapshot is not None:
+            conn.close()
+            series = self.load_series_from_snapshot(since_date)
+        else:
+            # ستون sanad_date_key عدد YYYYMMDD است؛ فیلتر پنجره جستجوی بازه‌ای روی ایندکس پوششی
+            # (sanad_date_key, policy_id, value) است و فقط سطرهای پنجره خوانده می‌شوند
+            if since_date:
+                query = 'SELECT policy_id, sanad_date_key, value FROM certificates WHERE sanad_date_key >= ?'
+                params = (jalali_date_key(since_date),)
+            else:
+                query = 'SELECT policy_id, COALESCE(sanad_date_key, jalali_key(sanad_date)), value FROM certificates'
+                params = ()
+            cursor.execute(query, params)
+            chunks = []
+            while True:
+                rows = cursor.fetchmany(100000)
+                if not rows:
+                    break
+                chunks.append(np.array(rows, dtype=np.int64))
+            conn.close()
+            series = np.concatenate(chunks) if chunks else np.zeros((0, 3), dtype=np.int64)
+
+        if policies:
+            ids, companies, numbers, dates, totals, remainings = zip(*policies)
+        else:
+            ids, companies, numbers, dates, totals, remainings = (), (), (), (), (), ()
+        data = {
+            'policy_id': np.array(ids, dtype=np.int64),
+            'company_name': np.array(companies, dtype=object),
+            'policy_number': np.array(numbers, dtype=object),
+            'total_value': np.array(totals, dtype=np.int64),
+            'remaining_value': np.array(remainings, dtype=np.int64),
+        }
+        policy_dates, policy_inverse = np.unique(np.array(dates, dtype=object).astype(str), return_inverse=True)
+        data['policy_day'] = np.array([jalali_to_ordinal(d) for d in policy_dates.tolist()],
+                                      dtype=np.int64)[policy_inverse.reshape(-1)]
+
+        series_ids, series_dates, series_values = series[:, 0], series[:, 1], series[:, 2]
+
+        # هر تاریخ یکتا فقط یک بار تبدیل می‌شود
+        unique_dates, inverse = np.unique(series_dates, return_inverse=True)
+        unique_days = np.array(
+            [jalali_to_ordinal(f"{d // 10000}/{d // 100 % 100}/{d % 100}") for d in unique_dates.tolist()],
+            dtype=np.int64)
+        series_days = unique_days[inverse.reshape(-1)]
+
+        positions = np.searchsorted(data['policy_id'], series_ids)
+        positions = np.clip(positions, 0, max(len(data['policy_id']) - 1, 0))
+        valid = series_days >= 0
+        if len(data['policy_id']):
+            valid &= data['policy_id'][positions] == series_ids
+        else:
+            valid[:] = False
+
+        data['series_index'] = positions[valid]
+        data['series_day'] = series_days[valid]
+        data['series_value'] = series_values[valid]
+        return data
+
+    def load_series_from_snapshot(self, since_date=None):
+        import numpy as np
+        self.snapshot.refresh()
+        dates = self.snapshot.column('certificates', 'sanad_date')
+        selected = slice(None)
+        if since_date:
+            selected = dates >= jalali_date_key(since_date)
+        return np.column_stack((self.snapshot.column('certificates', 'policy_id')[selected],
+                                dates[selected],
+                                self.snapshot.column('certificates', 'value')[selected]))
+
+    def forecast(self, today=None, data=None):
+        """محاسبه نرخ مصرف روزانه در پنجره اخیر و تاریخ پیش‌بینی‌شده اتمام مانده برای همه بیمه‌نامه‌ها"""
+        import numpy as np
+        if today is None:
+            today = date.today().toordinal()
+        if data is None:
+            data = self.load_series(ordinal_to_jalali(today - self.window_days + 1))
+
+        count = len(data['policy_id'])
+        index, day, value = data['series_index'], data['series_day'], data['series_value']
+
+        in_window = (day > today - self.window_days) & (day <= today)
+        consumed = np.bincount(index[in_window], weights=value[in_window], minlength=count)
+
+        # برای بیمه‌نامه‌های جدیدتر از پنجره، طول پنجره از تاریخ صدور بیمه‌نامه حساب می‌شود
+        first_day = np.maximum(today - self.window_days + 1, data['policy_day'])
+        span = np.maximum(today - first_day + 1, 1)
+
+        daily_rate = consumed / span
+        remaining = data['remaining_value'].astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            days_left = np.where(daily_rate > 0, remaining / daily_rate, np.inf)
+        days_left = np.where(remaining <= 0, 0.0, days_left)
+
+        depletion_day = np.full(count, -1, dtype=np.int64)
+        finite = np.isfinite(days_left)
+        depletion_day[finite] = today + np.ceil(days_left[finite]).astype(np.int64)
+
+        data['daily_rate'] = daily_rate
+        data['days_left'] = days_left
+        data['depletion_day'] = depletion_day
+        return data
+
+    def depleting_within(self, days, today=None, data=None):
+        """بیمه‌نامه‌هایی که مانده آن‌ها تا چند روز آینده تمام می‌شود، به ترتیب زودترین اتمام"""
+        import numpy as np
+        data = self.forecast(today, data)
+        selected = np.flatnonzero((data['days_left'] <= days) & (data['remaining_value'] > 0))
+        selected = selected[np.argsort(data['days_left'][selected], kind='stable')]
+        return [
+            (int(data['policy_id'][i]), data['company_name'][i], data['policy_number'][i],
+             int(data['remaining_value'][i]), float(data['daily_rate'][i]), int(data['depletion_day'][i]))
+            for i in selected
+        ]
+
+def split_cottages(cottage_numbers):
+    return [c.strip() for c in cottage_numbers.split('-') if c.strip()]
+
+def reconcile_policy_chunk(db_path, policy_ids):
+    """بررسی مانده و زنجیره remaining_after برای دسته‌ای از بیمه‌نامه‌ها (در یک پردازه جدا اجرا می‌شود)"""
+    import numpy as np
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    cursor = conn.cursor()
+    placeholders = ','.join('?' * len(policy_ids))
+    cursor.execute(f'SELECT id, total_value, remaining_value FROM policies WHERE id IN ({placeholders}) ORDER BY id', policy_ids)
+    policies = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 3)
+    cursor.execute(f'''
+        SELECT policy_id, id, sanad_id, value, remaining_after FROM certificates
+        WHERE policy_id IN ({placeholders}) ORDER BY policy_id, id
+    ''', policy_ids)
+    rows = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 5)
+    conn.close()
+
+    balance_issues = []
+    chain_issues = []
+    if not len(policies):
+        return balance_issues, chain_issues
+
+    positions = np.searchsorted(policies[:, 0], rows[:, 0])
+    known = positions < len(policies)
+    known[known] = policies[positions[known], 0] == rows[known, 0]
+    rows, positions = rows[known], positions[known]
+
+    # مجموع تجمعی ارزش گواهی‌ها درون هر بیمه‌نامه
+    running = np.cumsum(rows[:, 3])
+    starts = np.flatnonzero(np.r_[True, rows[1:, 0] != rows[:-1, 0]]) if len(rows) else np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(running[starts] - rows[starts, 3], np.diff(np.r_[starts, len(rows)]))
+    used = running - offsets
+    expected_after = policies[positions, 1] - used
+    for i in np.flatnonzero(rows[:, 4] != expected_after):
+        chain_issues.append((int(rows[i, 0]), int(rows[i, 2]), int(rows[i, 4]), int(expected_after[i])))
+
+    spent = np.bincount(positions, weights=rows[:, 3], minlength=len(policies)).astype(np.int64)
+    expected_remaining = policies[:, 1] - spent
+    for i in np.flatnonzero(policies[:, 2] != expected_remaining):
+        balance_issues.append((int(policies[i, 0]), int(policies[i, 2]), int(expected_remaining[i])))
+    return balance_issues, chain_issues
+
+def find_duplicate_sanad_ids(db_path, after_id=0):
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    cursor = conn.cursor()
+    query = 'SELECT sanad_id, COUNT(*) FROM certificates'
+    if after_id:
+        query += ' WHERE sanad_id IN (SELECT sanad_id FROM certificates WHERE id > ?)'
+    query += ' GROUP BY sanad_id HAVING COUNT(*) > 1 ORDER BY sanad_id'
+    cursor.execute(query, (after_id,) if after_id else ())
+    duplicates = cursor.fetchall()
+    conn.close()
+    return duplicates
+
+def find_duplicate_cottages(db_path, after_id=0):
+    """شماره‌های کوتاژ تکراری؛ شمارش در یک جدول موقت انجام می‌شود تا حافظه محدود بماند"""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    cursor = conn.cursor()
+    wanted = None
+    if after_id:
+        cursor.execute('SELECT cottage_numbers FROM certificates WHERE id > ?', (after_id,))
+        wanted = {c for row in cursor.fetchall() for c in split_cottages(row[0])}
+        if not wanted:
+            conn.close()
+            return []
+
+    temp = sqlite3.connect("")
+    temp.execute('CREATE TABLE cottages (cottage TEXT, sanad_id INTEGER, allocation_id INTEGER)')
+    # گواهی‌های یک تخصیص چندبیمه‌نامه‌ای کوتاژ مشترک دارند و تکرار حساب نمی‌شوند
+    cursor.execute('''
+        SELECT c.sanad_id, c.cottage_numbers, COALESCE(l.allocation_id, -c.id)
+        FROM certificates c LEFT JOIN certificate_links l ON l.certificate_id = c.id
+    ''')
+    while True:
+        rows = cursor.fetchmany(100000)
+        if not rows:
+            break
+        temp.executemany('INSERT INTO cottages VALUES (?, ?, ?)', (
+            (cottage, sanad_id, allocation_id) for sanad_id, cottage_numbers, allocation_id in rows
+            for cottage in split_cottages(cottage_numbers)
+            if wanted is None or cottage in wanted))
+    conn.close()
+    duplicates = temp.execute('''
+        SELECT cottage, GROUP_CONCAT(sanad_id) FROM cottages
+        GROUP BY cottage HAVING COUNT(DISTINCT allocation_id) > 1 ORDER BY cottage
+    ''').fetchall()
+    temp.close()
+    return [(cottage, [int(s) for s in sanad_ids.split(',')]) for cottage, sanad_ids in duplicates]
+
+class ReconciliationEngine:
+    """بررسی موازی و افزایشی سازگاری مانده بیمه‌نامه‌ها، زنجیره مانده گواهی‌ها و شماره‌های تکراری
+
+    بیمه‌نامه‌های تغییرکرده از جدول policy_changes (پرشده توسط تریگر) خوانده می‌شوند، پس دستکاری مستقیم مانده
+    یا گواهی‌ها هم دیده می‌شود. پس از هر اجرا آخرین seq این جدول و آخرین id گواهی در settings ذخیره می‌شود؛
+    این نشانه‌ها از اولین تغییر بیمه‌نامه‌ها و گواهی‌های دارای مغایرت جلوتر نمی‌روند تا اجرای بعدی دوباره آن‌ها را بررسی کند.
+    اجرای اول (بدون نشانه ذخیره‌شده) کامل است.
+
+    نمایندگی هنگام ساخت موتور ثابت می‌شود و همه خواندن‌ها و نوشتن‌ها روی همان انجام می‌شوند، حتی اگر کاربر
+    در حین اجرای پس‌زمینه نمایندگی فعال را عوض کند.
+    """
+
+    CHUNK_SIZE = 500
+
+    def __init__(self, db_manager, workers=None, tenant=None):
+        self.db_manager = db_manager
+        self.workers = workers
+        self.tenant = tenant or db_manager.tenant
+
+    def touched_policies(self, cursor, change_mark, last_change):
+        cursor.execute('SELECT DISTINCT policy_id FROM policy_changes WHERE seq > ? AND seq <= ?',
+                       (change_mark, last_change))
+        return sorted(row[0] for row in cursor.fetchall())
+
+    @staticmethod
+    def hold_back_changes(cursor, policy_ids, change_mark, last_change):
+        """نشانه جدید policy_changes: درست پیش از اولین تغییر بیمه‌نامه‌های دارای مغایرت
+
+        بیمه‌نامه‌ای که در این بازه تغییری ثبت‌شده ندارد (مثلاً در اجرای کامل) دوباره در دفتر تغییرات ثبت می‌شود.
+        """
+        earliest = {}
+        for start in range(0, len(policy_ids), 900):
+            batch = policy_ids[start:start + 900]
+            placeholders = ','.join('?' * len(batch))
+            cursor.execute(f'''
+                SELECT policy_id, MIN(seq) FROM policy_changes
+                WHERE seq > ? AND seq <= ? AND policy_id IN ({placeholders}) GROUP BY policy_id
+            ''', (change_mark, last_change, *batch))
+            earliest.update(cursor.fetchall())
+        cursor.executemany('INSERT INTO policy_changes (policy_id) VALUES (?)',
+                           [(policy_id,) for policy_id in policy_ids if policy_id not in earliest])
+        return min(earliest.values()) - 1 if earliest else last_change
+
+    @staticmethod
+    def hold_back_certificates(cursor, sanad_ids, certificate_mark, last_certificate):
+        """نشانه جدید گواهی‌ها: درست پیش از اولین گواهی جدید با شماره سند تکراری یا کوتاژ تکراری"""
+        earliest = None
+        for start in range(0, len(sanad_ids), 900):
+            batch = sanad_ids[start:start + 900]
+            placeholders = ','.join('?' * len(batch))
+            cursor.execute(f'SELECT MIN(id) FROM certificates WHERE id > ? AND id <= ? AND sanad_id IN ({placeholders})',
+                           (certificate_mark, last_certificate, *batch))
+            found = cursor.fetchone()[0]
+            if found is not None:
+                earliest = found if earliest is None else min(earliest, found)
+        return earliest - 1 if earliest is not None else last_certificate
+
+    def run(self, full=False):
+        tenant = self.tenant
+        if not self.db_manager.storage_for(tenant).file_backed:
+            raise ValueError("reconciliation reads the SQLite file directly")
+        db_path = self.db_manager.tenants.get(tenant)["db_path"]
+        change_mark = self.db_manager.get_setting('reconcile_change_seq', tenant=tenant)
+        full = full or change_mark is None
+        change_mark = 0 if full else int(change_mark)
+        certificate_mark = 0 if full else int(self.db_manager.get_setting('reconcile_certificate_id', 0, tenant=tenant))
+
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM certificates')
+        last_certificate = cursor.fetchone()[0]
+        cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM policy_changes')
+        last_change = cursor.fetchone()[0]
+        if full:
+            cursor.execute('SELECT id FROM policies ORDER BY id')
+            policy_ids = [row[0] for row in cursor.fetchall()]
+        else:
+            policy_ids = self.touched_policies(cursor, change_mark, last_change)
+        conn.close()
+
+        report = {
+            'checked_policies': len(policy_ids),
+            'balance': [],
+            'chain': [],
+            'duplicate_sanad_ids': [],
+            'duplicate_cottages': [],
+        }
+        chunks = [policy_ids[i:i + self.CHUNK_SIZE] for i in range(0, len(policy_ids), self.CHUNK_SIZE)]
+        # spawn برای جلوگیری از fork کردن پردازه رابط کاربری
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+            sanad_future = pool.submit(find_duplicate_sanad_ids, db_path, certificate_mark)
+            cottage_future = pool.submit(find_duplicate_cottages, db_path, certificate_mark)
+            for balance_issues, chain_issues in pool.map(reconcile_policy_chunk, [db_path] * len(chunks), chunks):
+                report['balance'].extend(balance_issues)
+                report['chain'].extend(chain_issues)
+            report['duplicate_sanad_ids'] = sanad_future.result()
+            report['duplicate_cottages'] = cottage_future.result()
+
+        issue_policies = sorted({issue[0] for issue in report['balance'] + report['chain']})
+        issue_sanad_ids = sorted({sanad_id for sanad_id, _ in report['duplicate_sanad_ids']} |
+                                 {sanad_id for _, sanad_ids in report['duplicate_cottages'] for sanad_id in sanad_ids})
+        with self.db_manager.connection(tenant) as conn:
+            cursor = conn.cursor()
+            change_mark = self.hold_back_changes(cursor, issue_policies, change_mark, last_change)
+            certificate_mark = self.hold_back_certificates(cursor, issue_sanad_ids, certificate_mark, last_certificate)
+            # تغییراتی که پشت نشانه مانده‌اند دیگر لازم نیستند
+            cursor.execute('DELETE FROM policy_changes WHERE seq <= ?', (change_mark,))
+        self.db_manager.set_setting('reconcile_change_seq', change_mark, tenant=tenant)
+        self.db_manager.set_setting('reconcile_certificate_id', certificate_mark, tenant=tenant)
+        return report
+
+    @staticmethod
+    def format_report(report):
+        lines = [f"تعداد بیمه‌نامه‌های بررسی‌شده: {report['checked_policies']}"]
+        for policy_id, remaining_value, expected in report['balance']:
+            lines.append(f"مغایرت مانده بیمه‌نامه {policy_id}: ثبت‌شده {remaining_value:,} - محاسبه‌شده {expected:,}")
+        for policy_id, sanad_id, remaining_after, expected in report['chain']:
+            lines.append(f"مغایرت زنجیره مانده سند {sanad_id} (بیمه‌نامه {policy_id}): ثبت‌شده {remaining_after:,} - محاسبه‌شده {expected:,}")
+        for sanad_id, count in report['duplicate_sanad_ids']:
+            lines.append(f"شماره سند تکراری {sanad_id}: {count} بار")
+        for cottage, sanad_ids in report['duplicate_cottages']:
+            lines.append(f"کوتاژ تکراری {cottage}: اسناد {', '.join(map(str, sanad_ids))}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def issue_count(report):
+        return sum(len(report[key]) for key in ('balance', 'chain', 'duplicate_sanad_ids', 'duplicate_cottages'))
+
+class ReconciliationThread(QThread):
+    completed = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, engine, full=False, parent=None):
+        super().__init__(parent)
+        self.engine = engine
+        self.full = full
+
+    def run(self):
+        try:
+            self.completed.emit(self.engine.run(self.full))
+        except Exception as e:
+            self.failed.emit(str(e))
+
+class ForecastThread(QThread):
+    """بروزرسانی کش ستونی و محاسبه پیش‌بینی اتمام مانده بیرون از نخ رابط کاربری"""
+    completed = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, analytics, parent=None):
+        super().__init__(parent)
+        self.analytics = analytics
+
+    def run(self):
+        try:
+            self.completed.emit(self.analytics.forecast())
+        except Exception as e:
+            self.failed.emit(str(e))
+
+PERSIAN_NORMALIZATION = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ئ': 'ی', 'ك': 'ک', 'ة': 'ه', 'أ': 'ا', 'إ': 'ا', 'آ': 'ا',
+    '\u200c': ' ', '\u200f': None, '\u200e': None, 'ـ': None,
+    **{chr(0x064B + i): None for i in range(8)},
+    **{chr(0x06F0 + i): str(i) for i in range(10)},
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+})
+
+def normalize_persian(text):
+    """یکسان‌سازی حروف عربی/فارسی (ي/ی، ك/ک)، ارقام و فاصله‌ها برای جستجو"""
+    return " ".join(str(text).translate(PERSIAN_NORMALIZATION).casefold().split())
+
+class PrefixIndex:
+    """ایندکس پیشوندی روی کلیدهای نرمال‌شده؛ کلیدها مرتب نگهداری و با جستجوی دودویی پیدا می‌شوند"""
+
+    def __init__(self):
+        self.keys = []
+        self.values = []
+
+    def clear(self):
+        self.keys = []
+        self.values = []
+
+    def add(self, text, value):
+        key = normalize_persian(text)
+        position = bisect.bisect_right(self.keys, key)
+        self.keys.insert(position, key)
+        self.values.insert(position, value)
+
+    def remove(self, text, value):
+        key = normalize_persian(text)
+        position = bisect.bisect_left(self.keys, key)
+        while position < len(self.keys) and self.keys[position] == key:
+            if self.values[position] == value:
+                del self.keys[position]
+                del self.values[position]
+                return
+            position += 1
+
+    def search(self, prefix, limit=50):
+        key = normalize_persian(prefix)
+        position = bisect.bisect_left(self.keys, key)
+        matches = []
+        while position < len(self.keys) and len(matches) < limit and self.keys[position].startswith(key):
+            matches.append(self.values[position])
+            position += 1
+        return matches
+
+def edit_distance(a, b, limit):
+    """فاصله ویرایشی با جابه‌جایی نویسه‌های مجاور (Damerau محدود)؛ اگر از limit بیشتر شود limit + 1 برمی‌گرداند"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    # شماره‌های پشت‌سرهم پیشوند و پسوند مشترک طولانی دارند؛ حذف آن‌ها فاصله را تغییر نمی‌دهد
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < len(a) - start and end < len(b) - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    a = a[start:len(a) - end]
+    b = b[start:len(b) - end]
+    if not a or not b:
+        return min(max(len(a), len(b)), limit + 1)
+    previous_row = None
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        previous_row, row = row, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            row[j] = min(previous_row[j] + 1, row[j - 1] + 1, previous_row[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], before_previous[j - 2] + 1)
+        if min(row) > limit:
+            return limit + 1
+        before_previous = previous_row
+    return min(row[-1], limit + 1)
+
+def variant_hashes(keys):
+    """هش چندجمله‌ای هر کلید و همه حالت‌های حذف یک نویسه‌اش، برداری با numpy
+
+    هش رشته c برابر Σ c[k]·P^(k+1) به پیمانه 2^64 است. با حاصل‌جمع‌های پیشوندی، هش حالت حذف نویسه i برابر
+    پیشوند تا i به اضافه باقی‌مانده ضرب‌شده در وارون P است و برای همه کلیدها و همه iها یکجا محاسبه می‌شود.
+    خروجی: (هش‌ها، اندیس کلید صاحب هر هش)
+    """
+    import numpy as np
+    width = max(map(len, keys))
+    codes = np.array(keys, dtype=f'U{width}').view(np.uint32).reshape(len(keys), width).astype(np.uint64)
+    lengths = np.fromiter(map(len, keys), dtype=np.int64, count=len(keys))
+    powers = np.cumprod(np.full(width, VARIANT_HASH_BASE, dtype=np.uint64))
+    prefix = np.cumsum(codes * powers, axis=1, dtype=np.uint64)
+    total = prefix[:, -1]
+    before = np.zeros_like(prefix)
+    before[:, 1:] = prefix[:, :-1]
+    deleted = before + (total[:, None] - prefix) * np.uint64(VARIANT_HASH_INVERSE)
+    mask = np.arange(width) < lengths[:, None]
+    owners = np.arange(len(keys))
+    return (np.concatenate((total, deleted[mask])),
+            np.concatenate((owners, np.broadcast_to(owners[:, None], mask.shape)[mask])))
+
+VARIANT_HASH_BASE = 0x100000001B3
+VARIANT_HASH_INVERSE = pow(VARIANT_HASH_BASE, -1, 2 ** 64)
+
+class CottageIndex:
+    """ایندکس تشخیص شماره کوتاژهای تقریباً تکراری (غلط تایپی، جابه‌جایی ارقام)
+
+    برای هر کوتاژ هش خودش و همه حالت‌های حذف یک نویسه‌اش ذخیره می‌شود. دو کوتاژ با فاصله ویرایشی یک (و بیشتر حالت‌های
+    فاصله دو) دست‌کم یک حالت مشترک دارند، پس جستجو چند جستجوی دودویی روی آرایه مرتب هش‌هاست و برخلاف
+    n-gram به یکسان بودن ارقام ابتدایی شماره‌های پشت‌سرهم حساس نیست. درج‌های تکی در بافر کوچکی جمع و دسته‌ای ادغام می‌شوند.
+
+    نویسنده‌ها با قفل writer به نوبت می‌نویسند و آرایه‌های ادغام‌شده را بیرون از lock می‌سازند؛ lock فقط برای
+    جایگزینی مرجع آرایه‌ها گرفته می‌شود تا جستجوی هم‌زمان در رابط کاربری منتظر ادغام نماند.
+    """
+
+    MERGE_THRESHOLD = 8192
+    BATCH_SIZE = 50000
+    MIN_LENGTH = 4
+
+    def __init__(self, max_distance=2):
+        import numpy as np
+        self.max_distance = max_distance
+        self.cottages = []
+        self.sanad_ids = array('q')
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.pending = {}
+        self.pending_count = 0
+        self.last_certificate_id = 0
+        self.lock = threading.Lock()
+        self.writer = threading.Lock()
+        self.refreshing = threading.Lock()
+        self.requested = False
+        self.cancelled = False
+
+    @staticmethod
+    def normalize(cottage):
+        return "".join(normalize_persian(cottage).split())
+
+    def add_many(self, rows):
+        """افزودن [(sanad_id, cottage_numbers)]؛ هر کوتاژ از رشته جداشده با - جداگانه ایندکس می‌شود"""
+        keys = []
+        sanad_ids = []
+        for sanad_id, cottage_numbers in rows:
+            for cottage in split_cottages(cottage_numbers):
+                key = self.normalize(cottage)
+                if key:
+                    keys.append(key)
+                    sanad_ids.append(sanad_id)
+        if not keys:
+            return
+        hashes, owners = variant_hashes(keys)
+        with self.writer:
+            with self.lock:
+                ids = owners + len(self.cottages)
+                self.cottages.extend(keys)
+                self.sanad_ids.extend(sanad_ids)
+                if len(hashes) < self.MERGE_THRESHOLD:
+                    for h, cottage_id in zip(hashes.tolist(), ids.tolist()):
+                        self.pending.setdefault(h, []).append(cottage_id)
+                    self.pending_count += len(hashes)
+                    if self.pending_count < self.MERGE_THRESHOLD:
+                        return
+            if len(hashes) >= self.MERGE_THRESHOLD:
+                merged = self.merged(hashes, ids)
+                with self.lock:
+                    self.hashes, self.ids = merged
+            else:
+                self.merge_pending()
+
+    def merged(self, hashes, ids):
+        """آرایه‌های جدید ادغام‌شده؛ آرایه‌های فعلی تغییر نمی‌کنند (فقط نویسنده آن‌ها را جایگزین می‌کند)"""
+        import numpy as np
+        order = np.argsort(hashes, kind='stable')
+        positions = np.searchsorted(self.hashes, hashes[order], side='right')
+        return np.insert(self.hashes, positions, hashes[order]), np.insert(self.ids, positions, ids[order])
+
+    def merge_pending(self):
+        import numpy as np
+        # بافر فقط توسط نویسنده فعلی (دارنده writer) تغییر می‌کند، پس خواندن آن بیرون از lock امن است
+        hashes = np.fromiter((h for h, ids in self.pending.items() for _ in ids), dtype=np.uint64, count=self.pending_count)
+        ids = np.fromiter((i for ids in self.pending.values() for i in ids), dtype=np.int64, count=self.pending_count)
+        merged = self.merged(hashes, ids)
+        with self.lock:
+            self.hashes, self.ids = merged
+            self.pending = {}
+            self.pending_count = 0
+
+    def refresh(self, db_manager, tenant=None):
+        """خواندن گواهی‌های جدیدتر از آخرین شناسه خوانده‌شده، به صورت دسته‌ای تا اتصال مدت کوتاهی گرفته شود
+
+        اگر بارگذاری دیگری در جریان باشد (ساخت اولیه در پس‌زمینه) درخواست با requested ثبت می‌شود و همان بارگذاری
+        پس از پایان یک دور دیگر ردیف‌های جدید را می‌خواند.
+        """
+        self.requested = True
+        while self.requested and not self.cancelled:
+            if not self.refreshing.acquire(blocking=False):
+                return
+            try:
+                self.requested = False
+                while not self.cancelled:
+                    with db_manager.connection(tenant) as conn:
+                        cursor = conn.cursor()
+                        cursor.execute('SELECT id, sanad_id, cottage_numbers FROM certificates WHERE id > ? ORDER BY id LIMIT ?',
+                                       (self.last_certificate_id, self.BATCH_SIZE))
+                        rows = cursor.fetchall()
+                    if not rows:
+                        break
+                    self.add_many((sanad_id, cottage_numbers) for _, sanad_id, cottage_numbers in rows)
+                    self.last_certificate_id = rows[-1][0]
+            finally:
+                self.refreshing.release()
+
+    def candidates(self, key):
+        import numpy as np
+        hashes, _ = variant_hashes([key])
+        starts = np.searchsorted(self.hashes, hashes, side='left')
+        ends = np.searchsorted(self.hashes, hashes, side='right')
+        found = set()
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            found.update(self.ids[start:end].tolist())
+        for h in hashes.tolist():
+            found.update(self.pending.get(h, ()))
+        return found
+
+    def search(self, cottage_numbers, limit=5):
+        """کوتاژهای مشابه به صورت [(امتیاز شباهت, کوتاژ ورودی, کوتاژ ثبت‌شده, sanad_id)] از بیشترین شباهت"""
+        matches = {}
+        with self.lock:
+            for cottage in split_cottages(cottage_numbers):
+                key = self.normalize(cottage)
+                if len(key) < self.MIN_LENGTH:
+                    continue
+                for cottage_id in self.candidates(key):
+                    stored = self.cottages[cottage_id]
+                    distance = edit_distance(key, stored, self.max_distance)
+                    if distance > self.max_distance:
+                        continue
+                    score = 1 - distance / max(len(key), len(stored))
+                    sanad_id = self.sanad_ids[cottage_id]
+                    if matches.get((stored, sanad_id), (0,))[0] < score:
+                        matches[(stored, sanad_id)] = (score, cottage, stored, sanad_id)
+        return sorted(matches.values(), key=lambda match: (-match[0], match[3]))[:limit]
+
+class PickerModel(QAbstractListModel):
+    """مدل لیست مشترک برای ComboBoxها؛ هر سطر (متن نمایشی، داده) است و با تغییرات جزئی بروزرسانی می‌شود
+
+    نگاشت داده به شماره سطر (rows) همراه با entries نگهداری می‌شود تا row_of و search بدون پیمایش لیست انجام شوند؛
+    تغییر entries فقط از طریق set_entries، insert_entry و remove_entry انجام می‌شود.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.entries = []
+        self.rows = {}
+        self.index = PrefixIndex()
+
+    def set_entries(self, entries):
+        self.entries = entries
+        self.rows = {value: row for row, (_, value) in enumerate(entries)}
+
+    def insert_entry(self, position, entry):
+        self.entries.insert(position, entry)
+        for row in range(position + 1, len(self.entries)):
+            self.rows[self.entries[row][1]] = row
+        self.rows[entry[1]] = position
+
+    def remove_entry(self, position):
+        _, value = self.entries.pop(position)
+        del self.rows[value]
+        for row in range(position, len(self.entries)):
+            self.rows[self.entries[row][1]] = row
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.entries)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.entries):
+            return None
+        text, value = self.entries[index.row()]
+        if role in (Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.EditRole):
+            return text
+        if role == Qt.ItemDataRole.UserRole:
+            return value
+        return None
 
-    def get_next_sanad_id(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT MAX(sanad_id) FROM certificates')
-        result = cursor.fetchone()[0]
-        next_id = (result or 3999) + 1
-        conn.close()
-        return next_id
+    def row_of(self, value):
+        return self.rows.get(value, -1)
 
-    def add_company(self, name):
-        conn = sqlite3.connect(self.db_path)
-        try:
-            cursor = conn.cursor()
-            cursor.execute('INSERT INTO companies (name) VALUES (?)', (name,))
-            conn.commit()
-            return True
-        except sqlite3.IntegrityError:
-            return False
-        finally:
-            conn.close()
+    def search(self, prefix, limit=50):
+        """(متن، داده) سطرهایی که کلید جستجوی آن‌ها با prefix شروع می‌شود"""
+        return [self.entries[self.rows[value]] for value in self.index.search(prefix, limit) if value in self.rows]
 
-    def get_companies(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT name FROM companies ORDER BY name')
-        companies = [row[0] for row in cursor.fetchall()]
-        conn.close()
-        return companies
+class CompanyListModel(PickerModel):
+    """نام شرکت‌ها به ترتیب الفبایی با یک سطر خالی در ابتدا"""
 
-    def add_policy(self, company_name, policy_number, policy_date, total_value):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                INSERT INTO policies (company_name, policy_number, policy_date, total_value, remaining_value)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (company_name, policy_number, policy_date, total_value, total_value))
-            conn.commit()
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.names = []
+
+    def reset(self, names):
+        self.beginResetModel()
+        self.names = sorted(names)
+        self.set_entries([("", "")] + [(name, name) for name in self.names])
+        self.index.clear()
+        for name in self.names:
+            self.index.add(name, name)
+        self.endResetModel()
+
+    def row_of(self, value):
+        position = bisect.bisect_left(self.names, value)
+        if position < len(self.names) and self.names[position] == value:
+            return position + 1
+        return -1
+
+    def search(self, prefix, limit=50):
+        return [(name, name) for name in self.index.search(prefix, limit)]
+
+    def insert_name(self, name):
+        if self.row_of(name) >= 0:
+            return
+        position = bisect.bisect_left(self.names, name)
+        self.beginInsertRows(QModelIndex(), position + 1, position + 1)
+        self.names.insert(position, name)
+        self.insert_entry(position + 1, (name, name))
+        self.index.add(name, name)
+        self.endInsertRows()
+
+class PolicyListModel(PickerModel):
+    """بیمه‌نامه‌های دارای مانده شرکت انتخاب‌شده؛ سطرهای قالب‌بندی‌شده هر شرکت یک بار ساخته و کش می‌شوند
+
+    برای هر شرکت، شماره‌های بیمه‌نامه به صورت یک لیست مرتب موازی با سطرها (numbers) نگهداری می‌شوند تا جای درج
+    با جستجوی دودویی پیدا شود.
+    """
+
+    EMPTY_TEXT = "هیچ بیمه‌نامه‌ای با مانده موجود نیست"
+
+    def __init__(self, db_manager, parent=None):
+        super().__init__(parent)
+        self.db_manager = db_manager
+        self.company_name = ""
+        self.cache = {}
+        self.numbers = {}
+        self.by_id = {}
+
+    @staticmethod
+    def format_policy(policy_number, policy_date, remaining_value):
+        return f"شماره {policy_number} - تاریخ {policy_date} - مانده: {remaining_value:,}"
+
+    def invalidate(self):
+        self.cache = {}
+        self.numbers = {}
+        self.by_id = {}
+        self.set_company(self.company_name, force=True)
+
+    def rows_for(self, company_name):
+        rows = self.cache.get(company_name)
+        if rows is None:
+            rows = [
+                {'policy_id': policy_id, 'policy_number': policy_number, 'policy_date': policy_date,
+                 'total_value': total_value, 'remaining_value': remaining_value,
+                 'text': self.format_policy(policy_number, policy_date, remaining_value)}
+                for policy_id, policy_number, policy_date, total_value, remaining_value
+                in self.db_manager.get_policies(company_name)
+            ]
+            self.cache[company_name] = rows
+            self.numbers[company_name] = [row['policy_number'] for row in rows]
+            self.by_id.update((row['policy_id'], row) for row in rows)
+        return rows
+
+    def set_company(self, company_name, force=False):
+        if company_name == self.company_name and not force:
+            return
+        self.beginResetModel()
+        self.company_name = company_name
+        self.rebuild_entries()
+        self.endResetModel()
+
+    def rebuild_entries(self):
+        self.index.clear()
+        if not self.company_name:
+            self.set_entries([])
+            return
+        rows = self.rows_for(self.company_name)
+        if not rows:
+            self.set_entries([(self.EMPTY_TEXT, None)])
+            return
+        self.set_entries([(row['text'], row['policy_id']) for row in rows])
+        for row in rows:
+            self.index.add(row['policy_number'], row['policy_id'])
+
+    def policy(self, policy_id):
+        """ردیف بیمه‌نامه دارای مانده از شرکت انتخاب‌شده؛ اگر بیمه‌نامه تمام شده یا متعلق به شرکت دیگری باشد None"""
+        row = self.by_id.get(policy_id)
+        if row is None or self.row_of(policy_id) < 0:
+            return None
+        return row
+
+    def add_policy(self, company_name, policy_id, policy_number, policy_date, total_value, remaining_value):
+        rows = self.cache.get(company_name)
+        if rows is None or remaining_value <= 0:
+            return
+        row = {'policy_id': policy_id, 'policy_number': policy_number, 'policy_date': policy_date,
+               'total_value': total_value, 'remaining_value': remaining_value,
+               'text': self.format_policy(policy_number, policy_date, remaining_value)}
+        numbers = self.numbers[company_name]
+        position = bisect.bisect_right(numbers, policy_number)
+        numbers.insert(position, policy_number)
+        rows.insert(position, row)
+        self.by_id[policy_id] = row
+        if company_name != self.company_name:
+            return
+        if len(rows) == 1:
+            self.beginResetModel()
+            self.rebuild_entries()
+            self.endResetModel()
+            return
+        self.beginInsertRows(QModelIndex(), position, position)
+        self.insert_entry(position, (row['text'], policy_id))
+        self.index.add(policy_number, policy_id)
+        self.endInsertRows()
+
+    def update_remaining(self, company_name, policy_id, remaining_value):
+        rows = self.cache.get(company_name)
+        row = self.by_id.get(policy_id)
+        if rows is None or row is None:
+            return
+        visible = company_name == self.company_name
+        if remaining_value <= 0:
+            del self.by_id[policy_id]
+            if not visible:
+                position = rows.index(row)
+                del rows[position]
+                del self.numbers[company_name][position]
+                return
+            position = self.row_of(policy_id)
+            del rows[position]
+            del self.numbers[company_name][position]
+            if not rows:
+                self.beginResetModel()
+                self.rebuild_entries()
+                self.endResetModel()
+                return
+            self.beginRemoveRows(QModelIndex(), position, position)
+            self.remove_entry(position)
+            self.index.remove(row['policy_number'], policy_id)
+            self.endRemoveRows()
+            return
+        row['remaining_value'] = remaining_value
+        row['text'] = self.format_policy(row['policy_number'], row['policy_date'], remaining_value)
+        if visible:
+            position = self.row_of(policy_id)
+            self.entries[position] = (row['text'], policy_id)
+            changed = self.createIndex(position, 0)
+            self.dataChanged.emit(changed, changed)
+
+    def apply(self, event):
+        """اعمال رویداد تغییر جدول policies"""
+        for row in event.rows:
+            if event.action == 'insert':
+                self.add_policy(row['company_name'], row['id'], row['policy_number'], row['policy_date'],
+                                row['total_value'], row['remaining_value'])
+            else:
+                self.update_remaining(row['company_name'], row['id'], row['remaining_value'])
+
+class PolicyTableModel(QAbstractTableModel):
+    """جدول بیمه‌نامه‌ها به ترتیب (شرکت، شماره بیمه‌نامه)
+
+    متن سلول‌ها فقط برای سطرهای دیده‌شده ساخته می‌شود. رویدادهای تغییر با جستجوی دودویی روی کلید ترتیب
+    به درج، حذف یا بروزرسانی همان یک سطر تبدیل می‌شوند. با فیلتر شرکت، مانند get_policies فقط بیمه‌نامه‌های دارای مانده نمایش داده می‌شوند.
+    """
+
+    HEADERS = ["شرکت", "شماره بیمه‌نامه", "تاریخ", "ارزش کل", "مانده", "درصد باقیمانده"]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+        self.keys = []
+        self.by_id = {}
+        self.filter_company = None
+
+    def load(self, policies, filter_company=None):
+        self.beginResetModel()
+        self.filter_company = filter_company or None
+        if self.filter_company:
+            # فیلتر بر اساس شرکت ستون company_name را برنمی‌گرداند
+            policies = [(policy[0], self.filter_company) + tuple(policy[1:]) for policy in policies]
+        self.rows = [
+            {'id': policy_id, 'company_name': company_name, 'policy_number': policy_number, 'policy_date': policy_date,
+             'total_value': total_value, 'remaining_value': remaining_value}
+            for policy_id, company_name, policy_number, policy_date, total_value, remaining_value in policies
+        ]
+        self.keys = [(row['company_name'], row['policy_number']) for row in self.rows]
+        self.by_id = {row['id']: row for row in self.rows}
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.HEADERS[section]
+        return super().headerData(section, orientation, role)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        if role == Qt.ItemDataRole.UserRole:
+            return row['id']
+        if role != Qt.ItemDataRole.DisplayRole:
+            return None
+        column = index.column()
+        if column == 0:
+            return row['company_name']
+        if column == 1:
+            return row['policy_number']
+        if column == 2:
+            return row['policy_date']
+        if column == 3:
+            return f"{row['total_value']:,}"
+        if column == 4:
+            return f"{row['remaining_value']:,}"
+        if row['total_value'] > 0:
+            return f"{row['remaining_value'] / row['total_value'] * 100:.1f}%"
+        return "0%"
+
+    def policy_id(self, position):
+        return self.rows[position]['id'] if 0 <= position < len(self.rows) else None
+
+    def position_of(self, policy_id):
+        row = self.by_id.get(policy_id)
+        if row is None:
+            return -1
+        key = (row['company_name'], row['policy_number'])
+        position = bisect.bisect_left(self.keys, key)
+        # سطرهای هم‌کلید کنار هم‌اند؛ جستجو از محدوده آن‌ها بیرون نمی‌رود
+        while position < len(self.rows) and self.keys[position] == key:
+            if self.rows[position] is row:
+                return position
+            position += 1
+        # ترتیب یا ایندکس‌ها از هم جدا شده‌اند؛ بازسازی کامل از روی سطرها
+        self.rebuild()
+        for position, candidate in enumerate(self.rows):
+            if candidate['id'] == policy_id:
+                return position
+        return -1
+
+    def rebuild(self):
+        self.beginResetModel()
+        self.rows.sort(key=lambda row: (row['company_name'], row['policy_number']))
+        self.keys = [(row['company_name'], row['policy_number']) for row in self.rows]
+        self.by_id = {row['id']: row for row in self.rows}
+        self.endResetModel()
+
+    def visible(self, row):
+        if self.filter_company is None:
             return True
-        except sqlite3.IntegrityError:
-            return False
-        finally:
-            conn.close()
+        return row['company_name'] == self.filter_company and row['remaining_value'] > 0
 
-    def get_policies(self, company_name=None):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        if company_name:
-            cursor.execute('''
-                SELECT id, policy_number, policy_date, total_value, remaining_value 
-                FROM policies WHERE company_name = ? AND remaining_value > 0
-                ORDER BY policy_number
-            ''', (company_name,))
-        else:
-            cursor.execute('SELECT id, company_name, policy_number, policy_date, total_value, remaining_value FROM policies ORDER BY company_name, policy_number')
-        policies = cursor.fetchall()
-        conn.close()
-        return policies
+    def apply(self, event):
+        """اعمال رویداد تغییر جدول policies"""
+        for change in event.rows:
+            if event.action == 'insert':
+                row = dict(change)
+                if not self.visible(row):
+                    continue
+                key = (row['company_name'], row['policy_number'])
+                position = bisect.bisect_right(self.keys, key)
+                self.beginInsertRows(QModelIndex(), position, position)
+                self.rows.insert(position, row)
+                self.keys.insert(position, key)
+                self.by_id[row['id']] = row
+                self.endInsertRows()
+                continue
+            position = self.position_of(change['id'])
+            if position < 0:
+                continue
+            row = self.rows[position]
+            row['remaining_value'] = change['remaining_value']
+            if not self.visible(row):
+                self.beginRemoveRows(QModelIndex(), position, position)
+                del self.rows[position]
+                del self.keys[position]
+                del self.by_id[row['id']]
+                self.endRemoveRows()
+                continue
+            self.dataChanged.emit(self.index(position, 4), self.index(position, 5))
 
-    def check_cottage_exists(self, cottage_numbers):
-        if not cottage_numbers:
-            return []
-        cottages = [c.strip() for c in cottage_numbers.split('-')]
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        placeholders = ','.join('?' * len(cottages))
-        query = f'SELECT sanad_id FROM certificates WHERE cottage_numbers LIKE "%{cottage_numbers}%" OR cottage_numbers LIKE "%{cottage_numbers.split("-")[0]}%"'
-        cursor.execute(query)
-        existing = cursor.fetchall()
-        conn.close()
-        return [row[0] for row in existing]
+class MatchListModel(QAbstractListModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.matches = []
 
-    def add_certificate(self, sanad_id, sanad_date, company_name, policy_id, policy_number, policy_date, cottage_numbers, count, value):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        remaining_after = 0
-        
-        cursor.execute('SELECT remaining_value FROM policies WHERE id = ?', (policy_id,))
-        current_remaining = cursor.fetchone()[0]
-        
-        if value > current_remaining:
-            conn.close()
-            return False, 0
-        
-        remaining_after = current_remaining - value
-        
-        cursor.execute('''
-            UPDATE policies SET remaining_value = remaining_value - ? WHERE id = ?
-        ''', (value, policy_id))
-        
-        cursor.execute('''
-            INSERT INTO certificates (sanad_id, sanad_date, company_name, policy_id, policy_number, policy_date, cottage_numbers, count, value, remaining_after)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (sanad_id, sanad_date, company_name, policy_id, policy_number, policy_date, cottage_numbers, count, value, remaining_after))
-        
-        conn.commit()
-        conn.close()
-        return True, remaining_after
+    def set_matches(self, matches):
+        self.beginResetModel()
+        self.matches = matches
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.matches)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.matches):
+            return None
+        text, value = self.matches[index.row()]
+        if role in (Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.EditRole):
+            return text
+        if role == Qt.ItemDataRole.UserRole:
+            return value
+        return None
+
+class TypeAheadCompleter(QCompleter):
+    """تکمیل خودکار ComboBox با جستجوی پیشوندی در PickerModel به جای فیلتر خطی Qt"""
+
+    def __init__(self, combo, picker_model):
+        super().__init__(combo)
+        self.combo = combo
+        self.picker_model = picker_model
+        self.matches = MatchListModel(self)
+        self.setModel(self.matches)
+        self.setCompletionMode(QCompleter.CompletionMode.UnfilteredPopupCompletion)
+        combo.setModel(picker_model)
+        combo.setEditable(True)
+        combo.setInsertPolicy(QComboBox.InsertPolicy.NoInsert)
+        combo.lineEdit().setCompleter(self)
+        combo.lineEdit().textEdited.connect(self.update_matches)
+        self.activated[QModelIndex].connect(self.select_match)
+
+    def update_matches(self, text):
+        self.matches.set_matches(self.picker_model.search(text) if text else [])
+
+    def select_match(self, index):
+        row = self.picker_model.row_of(index.data(Qt.ItemDataRole.UserRole))
+        if row >= 0:
+            self.combo.setCurrentIndex(row)
 
 class CertificatePrintDialog(QDialog):
-    def __init__(self, certificate_data, parent=None):
+    def __init__(self, certificate_data, parent=None, template=None, html=None):
         super().__init__(parent)
         self.certificate_data = certificate_data
+        self.template = template
+        self.html = html if html is not None else self.generate_certificate_html(certificate_data)
         self.setWindowTitle("پیش‌نمایش گواهی")
         self.setModal(True)
         self.setFixedSize(600, 800)
@@ -179,7 +2750,7 @@ class CertificatePrintDialog(QDialog):
         
         print_area = QTextEdit()
         print_area.setReadOnly(True)
-        print_area.setHtml(self.generate_certificate_html(certificate_data))
+        print_area.setHtml(self.html)
         layout.addWidget(print_area)
         
         button_layout = QHBoxLayout()
@@ -193,81 +2764,28 @@ class CertificatePrintDialog(QDialog):
         layout.addLayout(button_layout)
 
     def generate_certificate_html(self, data):
-        return f"""
-        <html dir="rtl">
-        <head>
-            <meta charset="UTF-8">
-            <style>
-                body {{ font-family: Tahoma, Arial, sans-serif; font-size: 14px; margin: 20px; }}
-                .header {{ border-bottom: 3px solid black; padding-bottom: 10px; margin-bottom: 20px; display: flex; justify-content: space-between; align-items: center; }}
-                .info-box {{ border: 2px solid black; padding: 15px; margin: 10px 0; border-radius: 5px; }}
-                .field {{ display: flex; justify-content: space-between; margin-bottom: 10px; }}
-                .label {{ font-weight: bold; width: 120px; }}
-                .value {{ text-align: right; }}
-                .footer {{ margin-top: 30px; text-align: center; }}
-                .signature-area {{ margin-top: 40px; }}
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <div style="text-align: center; flex: 1;">
-                    <h2>بیمه سینا</h2>
-                    <h3>گواهی حمل بار داخلی/وارداتی</h3>
-                </div>
-                <div style="text-align: center;">
-                    <div style="font-size: 12px; margin-bottom: 5px;">نمایندگی سهرابی فرد</div>
-                    <div style="font-size: 11px;">کد 6065</div>
-                </div>
-            </div>
-            
-            <div class="field">
-                <div class="label">شماره سند:</div>
-                <div class="value" style="font-family: Courier New; font-size: 16px;">{data['sanad_id']}</div>
-            </div>
-            <div class="field">
-                <div class="label">تاریخ صدور:</div>
-                <div class="value">{data['sanad_date']}</div>
-            </div>
-            
-            <div class="info-box">
-                <div class="field"><div class="label">نام شرکت:</div><div class="value">{data['company_name']}</div></div>
-                <div class="field"><div class="label">شماره بیمه‌نامه:</div><div class="value">{data['policy_number']}</div></div>
-                <div class="field"><div class="label">تاریخ بیمه‌نامه:</div><div class="value">{data['policy_date']}</div></div>
-                <div class="field"><div class="label">ارزش کل بیمه:</div><div class="value">{data['total_value']:,} ریال</div></div>
-            </div>
-            
-            <div class="info-box">
-                <div class="field"><div class="label">مبدا و مقصد:</div><div class="value">امارات عربی / بندرلنگه</div></div>
-                <div class="field"><div class="label">شماره کوتاژها:</div><div class="value">{data['cottage_numbers']}</div></div>
-                <div class="field"><div class="label">تعداد:</div><div class="value">{data['count']}</div></div>
-                <div class="field"><div class="label">ارزش محموله:</div><div class="value" style="font-weight: bold; font-size: 16px;">{data['value']:,} ریال</div></div>
-            </div>
-            
-            <div style="background: #f0f0f0; padding: 15px; border: 2px solid black; border-radius: 5px; margin-top: 20px;">
-                <div style="display: flex; justify-content: space-between; font-weight: bold;">
-                    <span>مانده اعتبار بیمه‌نامه:</span>
-                    <span>{data['remaining_after']:,} ریال</span>
-                </div>
-            </div>
-            
-            <div class="footer">
-                <div class="signature-area">
-                    <div style="text-align: center;">
-                        <div>مهر و امضاء بیمه‌گر</div>
-                    </div>
-                </div>
-                <div style="border-top: 1px solid black; padding-top: 10px; font-size: 12px; text-align: center;">
-                    آدرس: بندرلنگه، مجتمع یاقوت، طبقه اول | تلفن: 09173621318
-                </div>
-            </div>
-        </body>
-        </html>
-        """
+        template = self.template or TenantRegistry.single(DEFAULT_TENANT["db_path"]).certificate_template("default")
+        return template.safe_substitute(
+            data,
+            total_value=f"{data['total_value']:,}",
+            value=f"{data['value']:,}",
+            remaining_after=f"{data['remaining_after']:,}",
+        )
 
 class InsuranceSystem(QMainWindow):
+    # هشدارها و خطاهای notifier از نخ AlertDispatcher می‌رسند و با سیگنال به نخ رابط کاربری منتقل می‌شوند
+    alert_raised = pyqtSignal(object)
+    notifier_failed = pyqtSignal(str)
+    view_update_failed = pyqtSignal(str)
+
     def __init__(self):
         super().__init__()
-        self.db_manager = DatabaseManager("insurance_system.db")
+        self.audit_log = AuditLog("insurance_system_audit.log")
+        self.db_manager = DatabaseManager(audit_log=self.audit_log, tenants=TenantRegistry.load("tenants.json"))
+        self.setup_alert_notifiers()
+        self.forecast_thread = None
+        self.report_requested = False
+        self.attach_tenant_services()
         self.current_language = "fa"
         self.languages = {
             "fa": {"name": "فارسی", "direction": Qt.LayoutDirection.RightToLeft},
@@ -279,6 +2797,36 @@ class InsuranceSystem(QMainWindow):
         self.init_ui()
         self.apply_language()
 
+    def closeEvent(self, event):
+        # رکوردهای در صف دفتر ممیزی پیش از خروج روی دیسک نوشته می‌شوند
+        self.audit_log.flush()
+        super().closeEvent(event)
+
+    def attach_tenant_services(self):
+        db_path = self.db_manager.db_path
+        if self.db_manager.file_backed:
+            self.snapshot = ColumnarSnapshot(db_path, f"{Path(db_path).with_suffix('')}_columns")
+            self.analytics = PolicyAnalytics(db_path, snapshot=self.snapshot)
+        else:
+            self.snapshot = None
+            self.analytics = None
+        if getattr(self, "archive", None) is not None:
+            self.archive.close()
+        self.archive = CertificateArchive(self.db_manager.tenants.archive_directory(self.db_manager.tenant))
+        self.build_cottage_index()
+
+    def build_cottage_index(self):
+        """ساخت ایندکس کوتاژ نمایندگی فعال در پس‌زمینه؛ تا پایان ساخت، جستجو روی بخش خوانده‌شده انجام می‌شود"""
+        if getattr(self, "cottage_index", None) is not None:
+            self.cottage_index.cancelled = True
+        self.cottage_index = CottageIndex()
+        self.refresh_cottage_index()
+
+    def refresh_cottage_index(self, event=None):
+        """خواندن گواهی‌های جدید در ایندکس کوتاژ در یک نخ پس‌زمینه تا نخ رابط کاربری منتظر پایگاه داده نماند"""
+        threading.Thread(target=self.cottage_index.refresh, args=(self.db_manager, self.db_manager.tenant),
+                         daemon=True).start()
+
     def init_ui(self):
         self.setWindowTitle("سیستم صدور گواهی بیمه باربری")
         self.setGeometry(100, 100, 1400, 900)
@@ -292,6 +2840,17 @@ class InsuranceSystem(QMainWindow):
         sidebar.setFixedWidth(320)
         sidebar_layout = QVBoxLayout(sidebar)
         
+        # انتخاب نمایندگی
+        if len(self.db_manager.tenants.codes()) > 1:
+            tenant_group = QGroupBox("نمایندگی")
+            tenant_layout = QHBoxLayout(tenant_group)
+            self.tenant_combo = QComboBox()
+            for code in self.db_manager.tenants.codes():
+                self.tenant_combo.addItem(self.db_manager.tenants.get(code)["agency_name"], code)
+            self.tenant_combo.currentIndexChanged.connect(self.change_tenant)
+            tenant_layout.addWidget(self.tenant_combo)
+            sidebar_layout.addWidget(tenant_group)
+        
         # انتخاب زبان
         language_group = QGroupBox("انتخاب زبان")
         language_layout = QHBoxLayout(language_group)
@@ -341,6 +2900,23 @@ class InsuranceSystem(QMainWindow):
         restore_btn.clicked.connect(self.restore_database)
         sidebar_layout.addWidget(restore_btn)
         
+        self.reconcile_btn = QPushButton("بررسی یکپارچگی داده‌ها")
+        self.reconcile_btn.clicked.connect(self.run_reconciliation)
+        sidebar_layout.addWidget(self.reconcile_btn)
+        self.full_reconcile_check = QCheckBox("بررسی کامل (همه بیمه‌نامه‌ها)")
+        sidebar_layout.addWidget(self.full_reconcile_check)
+        
+        # هشدارهای مانده
+        alerts_group = QGroupBox("هشدارهای مانده")
+        alerts_layout = QVBoxLayout(alerts_group)
+        self.alerts_list = QListWidget()
+        alerts_layout.addWidget(self.alerts_list)
+        clear_alerts_btn = QPushButton("تأیید و پاک کردن هشدارها")
+        clear_alerts_btn.clicked.connect(self.acknowledge_alerts)
+        alerts_layout.addWidget(clear_alerts_btn)
+        sidebar_layout.addWidget(alerts_group)
+        self.reload_alerts()
+        
         sidebar_layout.addStretch()
         main_layout.addWidget(sidebar)
         
@@ -348,6 +2924,12 @@ class InsuranceSystem(QMainWindow):
         self.main_content = QTabWidget()
         main_layout.addWidget(self.main_content, 1)
         
+        # مدل‌های مشترک انتخاب شرکت و بیمه‌نامه
+        self.company_model = CompanyListModel(self)
+        self.policy_model = PolicyListModel(self.db_manager, self)
+        self.policy_table_model = PolicyTableModel(self)
+        self.subscribe_views()
+        
         # ایجاد تب‌ها
         self.setup_certificate_tab()
         self.setup_policy_tab()
@@ -525,10 +3107,12 @@ class InsuranceSystem(QMainWindow):
         form_layout = QFormLayout()
         
         self.company_combo_cert = QComboBox()
-        self.company_combo_cert.currentTextChanged.connect(self.load_policies_for_certificate)
+        self.company_combo_cert_completer = TypeAheadCompleter(self.company_combo_cert, self.company_model)
+        self.company_combo_cert.currentIndexChanged.connect(self.load_policies_for_certificate)
         form_layout.addRow("شرکت:", self.company_combo_cert)
         
         self.policy_combo = QComboBox()
+        self.policy_combo_completer = TypeAheadCompleter(self.policy_combo, self.policy_model)
         form_layout.addRow("بیمه‌نامه:", self.policy_combo)
         
         self.sanad_id_label = QLabel()
@@ -539,6 +3123,7 @@ class InsuranceSystem(QMainWindow):
         form_layout.addRow("تاریخ سند:", self.sanad_date_edit)
         
         self.cottage_edit = QLineEdit()
+        self.cottage_edit.textChanged.connect(self.check_similar_cottages)
         form_layout.addRow("شماره کوتاژها:", self.cottage_edit)
         
         self.count_spin = QSpinBox()
@@ -549,6 +3134,13 @@ class InsuranceSystem(QMainWindow):
         self.value_edit.textChanged.connect(self.format_currency)
         form_layout.addRow("ارزش (ریال):", self.value_edit)
         
+        self.allocation_combo = QComboBox()
+        self.allocation_combo.addItem("فقط بیمه‌نامه انتخاب‌شده", None)
+        self.allocation_combo.addItem("تقسیم خودکار: قدیمی‌ترین بیمه‌نامه اول", "oldest_first")
+        self.allocation_combo.addItem("تقسیم خودکار: نزدیک‌ترین مانده", "best_fit")
+        self.allocation_combo.addItem("تقسیم خودکار: کمترین تعداد بیمه‌نامه", "fewest_policies")
+        form_layout.addRow("تخصیص:", self.allocation_combo)
+        
         layout.addLayout(form_layout)
         
         self.register_button = QPushButton("ثبت و چاپ گواهی")
@@ -568,7 +3160,8 @@ class InsuranceSystem(QMainWindow):
         form_layout = QFormLayout()
         
         self.company_combo_policy = QComboBox()
-        self.company_combo_policy.currentTextChanged.connect(self.load_policies_for_policy_tab)
+        self.company_combo_policy_completer = TypeAheadCompleter(self.company_combo_policy, self.company_model)
+        self.company_combo_policy.currentIndexChanged.connect(self.load_policies_for_policy_tab)
         form_layout.addRow("شرکت:", self.company_combo_policy)
         
         self.policy_number_edit = QLineEdit()
@@ -588,9 +3181,25 @@ class InsuranceSystem(QMainWindow):
         save_policy_btn.clicked.connect(self.save_policy)
         layout.addWidget(save_policy_btn)
         
-        self.policies_table = QTableWidget()
-        self.policies_table.setColumnCount(6)
-        self.policies_table.setHorizontalHeaderLabels(["شرکت", "شماره بیمه‌نامه", "تاریخ", "ارزش کل", "مانده", "درصد باقیمانده"])
+        threshold_layout = QHBoxLayout()
+        self.threshold_edit = QLineEdit()
+        self.threshold_edit.setPlaceholderText("آستانه هشدار")
+        self.threshold_edit.textChanged.connect(self.format_currency)
+        self.threshold_kind_combo = QComboBox()
+        self.threshold_kind_combo.addItem("ریال", "amount")
+        self.threshold_kind_combo.addItem("درصد", "percent")
+        company_threshold_btn = QPushButton("آستانه برای شرکت")
+        company_threshold_btn.clicked.connect(lambda: self.save_alert_threshold('company'))
+        policy_threshold_btn = QPushButton("آستانه برای بیمه‌نامه انتخاب‌شده")
+        policy_threshold_btn.clicked.connect(lambda: self.save_alert_threshold('policy'))
+        threshold_layout.addWidget(self.threshold_edit)
+        threshold_layout.addWidget(self.threshold_kind_combo)
+        threshold_layout.addWidget(company_threshold_btn)
+        threshold_layout.addWidget(policy_threshold_btn)
+        layout.addLayout(threshold_layout)
+        
+        self.policies_table = QTableView()
+        self.policies_table.setModel(self.policy_table_model)
         layout.addWidget(self.policies_table)
         
         self.main_content.addTab(tab, "بیمه‌نامه‌ها")
@@ -620,6 +3229,15 @@ class InsuranceSystem(QMainWindow):
         company_filter_combo.currentTextChanged.connect(self.load_history)
         layout.addWidget(company_filter_combo)
         
+        reprint_layout = QHBoxLayout()
+        self.reprint_sanad_edit = QLineEdit()
+        self.reprint_sanad_edit.setPlaceholderText("شماره سند")
+        reprint_btn = QPushButton("چاپ مجدد از بایگانی")
+        reprint_btn.clicked.connect(self.reprint_certificate)
+        reprint_layout.addWidget(self.reprint_sanad_edit)
+        reprint_layout.addWidget(reprint_btn)
+        layout.addLayout(reprint_layout)
+        
         self.history_table = QTableWidget()
         layout.addWidget(self.history_table)
         
@@ -631,7 +3249,8 @@ class InsuranceSystem(QMainWindow):
         
         form_layout = QFormLayout()
         self.report_company_combo = QComboBox()
-        self.report_company_combo.currentTextChanged.connect(self.generate_report)
+        self.report_company_combo_completer = TypeAheadCompleter(self.report_company_combo, self.company_model)
+        self.report_company_combo.currentIndexChanged.connect(self.generate_report)
         form_layout.addRow("انتخاب شرکت:", self.report_company_combo)
         layout.addLayout(form_layout)
         
@@ -639,7 +3258,27 @@ class InsuranceSystem(QMainWindow):
         self.report_text.setReadOnly(True)
         layout.addWidget(self.report_text)
         
+        self.report_tab = tab
         self.main_content.addTab(tab, "گزارش مانده")
+        self.main_content.currentChanged.connect(self.generate_report)
+
+    def change_tenant(self):
+        self.db_manager.use_tenant(self.tenant_combo.currentData())
+        self.attach_tenant_services()
+        self.reload_views()
+
+    def reload_views(self):
+        """بارگذاری کامل همه نماها پس از تعویض نمایندگی یا بازیابی پشتیبان؛ به سیگنال تغییر ComboBoxها تکیه نمی‌کند"""
+        self.refresh_all_company_combos()
+        self.update_companies_table()
+        self.update_policies_table(self.selected_company(self.company_combo_policy))
+        self.reload_alerts()
+        self.generate_report()
+
+    def reload_alerts(self):
+        self.alerts_list.clear()
+        for alert in self.db_manager.get_alerts():
+            self.alerts_list.addItem(format_alert(alert))
 
     def change_language(self):
         lang_code = self.language_combo.currentData()
@@ -714,50 +3353,33 @@ class InsuranceSystem(QMainWindow):
         self.main_content.setCurrentIndex(index)
 
     def load_companies(self, combo_box):
-        """بارگذاری شرکت‌ها در یک ComboBox مشخص"""
-        companies = self.db_manager.get_companies()
+        """اتصال یک ComboBox به مدل مشترک شرکت‌ها"""
         if combo_box:
-            combo_box.clear()
-            combo_box.addItems([""] + companies)
-    
+            combo_box.setModel(self.company_model)
 
     def refresh_all_company_combos(self):
-        """بارگذاری شرکت‌ها در تمام ComboBox ها"""
-        companies = self.db_manager.get_companies()
-        combos_to_refresh = [
-            self.company_combo_cert,
-            self.company_combo_policy,
-            self.report_company_combo
-        ]
-        
-        for combo in combos_to_refresh:
-            if combo is not None:
-                combo.clear()
-                combo.addItems([""] + companies)
+        """بارگذاری مجدد کامل مدل مشترک شرکت‌ها و کش بیمه‌نامه‌ها"""
+        self.company_model.reset(self.db_manager.get_companies())
+        self.policy_model.invalidate()
 
+    def selected_company(self, combo):
+        """نام شرکت انتخاب‌شده (نه متن نیمه‌تایپ‌شده در ComboBox)"""
+        index = combo.currentIndex()
+        return combo.itemText(index) if index >= 0 else ""
 
     def load_policies_for_certificate(self):
         """بارگذاری بیمه‌نامه‌های مربوط به شرکت انتخاب شده"""
-        company_name = self.company_combo_cert.currentText()
-        self.policy_combo.clear()
-        
-        if not company_name or company_name == "":
-            return
-        
-        policies = self.db_manager.get_policies(company_name)
-        
-        if not policies:
-            self.policy_combo.addItem("هیچ بیمه‌نامه‌ای با مانده موجود نیست")
+        self.policy_model.set_company(self.selected_company(self.company_combo_cert))
+
+    def check_similar_cottages(self):
+        """نمایش کوتاژهای ثبت‌شده مشابه متن در حال تایپ، همراه با درصد شباهت"""
+        matches = self.cottage_index.search(self.cottage_edit.text())
+        if not matches:
+            self.warning_label.setText("")
             return
-        
-        for policy in policies:
-            policy_id, policy_number, policy_date, total_value, remaining_value = policy
-            text = f"شماره {policy_number} - تاریخ {policy_date} - مانده: {remaining_value:,}"
-            self.policy_combo.addItem(text, policy_id)
-        
-        if not policies:
-            self.policy_combo.addItem("هیچ بیمه‌نامه‌ای یافت نشد")
-            
+        lines = [f"{stored} (سند {sanad_id}) برای {cottage}: {score:.0%} شباهت" for score, cottage, stored, sanad_id in matches]
+        self.warning_label.setText("احتمال تکرار کوتاژ:\n" + "\n".join(lines))
+
     def register_certificate(self):
         cottage_numbers = self.cottage_edit.text().strip()
         if not cottage_numbers:
@@ -777,46 +3399,75 @@ class InsuranceSystem(QMainWindow):
             QMessageBox.warning(self, "خطا", "ارزش باید عدد معتبر باشد")
             return
 
+        strategy = self.allocation_combo.currentData()
+        if strategy:
+            self.register_allocated_certificates(cottage_numbers, value, strategy)
+            return
+
         policy_index = self.policy_combo.currentIndex()
-        if policy_index < 0:
+        policy_id = self.policy_combo.itemData(policy_index) if policy_index >= 0 else None
+        if policy_id is None:
             QMessageBox.warning(self, "خطا", "لطفاً بیمه‌نامه را انتخاب کنید")
             return
 
-        policy_id = self.policy_combo.itemData(policy_index)
-        company_name = self.company_combo_cert.currentText()
-        sanad_id = self.db_manager.get_next_sanad_id()
+        company_name = self.selected_company(self.company_combo_cert)
+        policy = self.policy_model.policy(policy_id)
+        if policy is None:
+            QMessageBox.warning(self, "خطا", "بیمه‌نامه انتخاب‌شده دیگر مانده ندارد؛ لطفاً بیمه‌نامه دیگری انتخاب کنید")
+            return
+        policy_number = policy['policy_number']
+        policy_date = policy['policy_date']
         sanad_date = self.sanad_date_edit.text()
 
-        success, remaining_after = self.db_manager.add_certificate(
-            sanad_id, sanad_date, company_name, policy_id, 
-            self.policy_combo.currentText().split(" - ")[0].replace("شماره ", ""),
-            sanad_date, cottage_numbers, self.count_spin.value(), value
+        success, certificate = self.db_manager.add_certificate(
+            None, sanad_date, company_name, policy_id, 
+            policy_number,
+            policy_date, cottage_numbers, self.count_spin.value(), value
         )
 
         if success:
             certificate_data = {
-                'sanad_id': sanad_id,
+                'sanad_id': certificate['sanad_id'],
                 'sanad_date': sanad_date,
                 'company_name': company_name,
-                'policy_number': self.policy_combo.currentText().split(" - ")[0].replace("شماره ", ""),
-                'policy_date': sanad_date,
-                'total_value': value,
+                'policy_number': policy_number,
+                'policy_date': policy_date,
+                'total_value': policy['total_value'],
                 'cottage_numbers': cottage_numbers,
                 'count': self.count_spin.value(),
                 'value': value,
-                'remaining_after': remaining_after
+                'remaining_after': certificate['remaining_after']
             }
             
-            dialog = CertificatePrintDialog(certificate_data, self)
-            dialog.exec()
-            
-            self.cottage_edit.clear()
-            self.value_edit.clear()
-            self.count_spin.setValue(1)
-            self.load_policies_for_certificate()
-            self.warning_label.setText("")
+            self.print_certificate(certificate_data)
+            self.clear_certificate_form()
         else:
-            QMessageBox.warning(self, "خطا", "موجودی بیمه‌نامه کافی نیست")
+            QMessageBox.warning(self, "خطا", "موجودی بیمه‌نامه کافی نیست؛ برای تقسیم بین چند بیمه‌نامه روش تخصیص را انتخاب کنید")
+
+    def register_allocated_certificates(self, cottage_numbers, value, strategy):
+        company_name = self.selected_company(self.company_combo_cert)
+        if not company_name:
+            QMessageBox.warning(self, "خطا", "لطفاً شرکت را انتخاب کنید")
+            return
+        success, certificates = self.db_manager.add_allocated_certificates(
+            self.sanad_date_edit.text(), company_name, cottage_numbers, self.count_spin.value(), value, strategy)
+        if not success:
+            QMessageBox.warning(self, "خطا", "مجموع مانده بیمه‌نامه‌های این شرکت برای این محموله کافی نیست")
+            return
+        for certificate in certificates:
+            self.print_certificate(certificate)
+        self.clear_certificate_form()
+
+    def print_certificate(self, certificate_data):
+        dialog = CertificatePrintDialog(certificate_data, self, self.db_manager.certificate_template())
+        self.archive.store(certificate_data['sanad_id'], dialog.html)
+        dialog.exec()
+
+    def clear_certificate_form(self):
+        self.cottage_edit.clear()
+        self.value_edit.clear()
+        self.count_spin.setValue(1)
+        self.warning_label.setText("")
 
     def add_company(self):
         company_name = self.company_name_edit.text().strip()
@@ -827,13 +3478,11 @@ class InsuranceSystem(QMainWindow):
         if self.db_manager.add_company(company_name):
             QMessageBox.information(self, "موفق", "شرکت با موفقیت اضافه شد")
             self.company_name_edit.clear()
-            self.refresh_all_company_combos()
-            self.update_companies_table()
         else:
             QMessageBox.warning(self, "خطا", "این شرکت قبلاً ثبت شده است")
 
     def save_policy(self):
-        company_name = self.company_combo_policy.currentText()
+        company_name = self.selected_company(self.company_combo_policy)
         policy_number = self.policy_number_edit.text().strip()
         policy_date = self.policy_date_edit.text().strip()
         
@@ -847,14 +3496,86 @@ class InsuranceSystem(QMainWindow):
             QMessageBox.warning(self, "خطا", "همه فیلدها الزامی هستند")
             return
 
-        if self.db_manager.add_policy(company_name, policy_number, policy_date, policy_value):
+        policy_id = self.db_manager.add_policy(company_name, policy_number, policy_date, policy_value)
+        if policy_id:
             QMessageBox.information(self, "موفق", "بیمه‌نامه با موفقیت ثبت شد")
             self.policy_number_edit.clear()
             self.policy_value_edit.clear()
-            self.update_policies_table()
         else:
             QMessageBox.warning(self, "خطا", "خطا در ثبت بیمه‌نامه")
 
+    def save_alert_threshold(self, scope):
+        kind = self.threshold_kind_combo.currentData()
+        try:
+            threshold = int(self.threshold_edit.text().replace(",", ""))
+        except ValueError:
+            QMessageBox.warning(self, "خطا", "آستانه باید عدد معتبر باشد")
+            return
+        if kind == 'percent' and not 0 <= threshold <= 100:
+            QMessageBox.warning(self, "خطا", "درصد آستانه باید بین 0 و 100 باشد")
+            return
+
+        if scope == 'company':
+            target = self.selected_company(self.company_combo_policy)
+            if not target:
+                QMessageBox.warning(self, "خطا", "لطفاً شرکت را انتخاب کنید")
+                return
+        else:
+            target = self.policy_table_model.policy_id(self.policies_table.currentIndex().row())
+            if target is None:
+                QMessageBox.warning(self, "خطا", "لطفاً بیمه‌نامه را از جدول انتخاب کنید")
+                return
+
+        self.db_manager.set_alert_threshold(scope, target, kind, threshold)
+        self.threshold_edit.clear()
+        QMessageBox.information(self, "موفق", "آستانه هشدار ثبت شد")
+
+    def setup_alert_notifiers(self):
+        dispatcher = self.db_manager.alert_dispatcher
+        self.desktop_notifier = None
+        if QSystemTrayIcon.isSystemTrayAvailable():
+            icon = self.windowIcon()
+            if icon.isNull():
+                icon = self.style().standardIcon(QStyle.StandardPixmap.SP_MessageBoxWarning)
+            self.tray_icon = QSystemTrayIcon(icon, self)
+            self.tray_icon.setToolTip("هشدارهای مانده بیمه‌نامه")
+            self.tray_icon.show()
+            self.desktop_notifier = DesktopNotifier(self.tray_icon)
+        self.alert_raised.connect(self.show_alert)
+        self.notifier_failed.connect(self.show_notifier_error)
+        dispatcher.notifiers.append(self.alert_raised.emit)
+        dispatcher.error_handlers.append(self.notifier_failed.emit)
+        dispatcher.notifiers.append(TenantWebhookNotifier(self.db_manager))
+
+    def show_alert(self, alert):
+        self.alerts_list.insertItem(0, format_alert(alert))
+        if self.desktop_notifier is not None:
+            self.desktop_notifier(alert)
+
+    def show_notifier_error(self, message):
+        self.statusBar().showMessage(message, 10000)
+
+    def acknowledge_alerts(self):
+        self.db_manager.acknowledge_alerts()
+        self.alerts_list.clear()
+
+    def subscribe_views(self):
+        """هر نما فقط سطرهای تغییرکرده را از رویدادهای DatabaseManager اعمال می‌کند"""
+        events = self.db_manager.events
+        self.view_update_failed.connect(self.show_notifier_error)
+        events.error_handlers.append(self.view_update_failed.emit)
+        events.subscribe('companies', self.apply_company_change)
+        events.subscribe('policies', self.policy_model.apply)
+        events.subscribe('policies', self.policy_table_model.apply)
+        events.subscribe('certificates', self.refresh_cottage_index)
+
+    def apply_company_change(self, event):
+        for row in event.rows:
+            self.company_model.insert_name(row['name'])
+            position = self.company_model.row_of(row['name']) - 1
+            self.companies_table.insertRow(position)
+            self.companies_table.setItem(position, 0, QTableWidgetItem(row['name']))
+
     def update_companies_table(self):
         companies = self.db_manager.get_companies()
         self.companies_table.setRowCount(len(companies))
@@ -867,60 +3588,152 @@ class InsuranceSystem(QMainWindow):
 
     def load_policies_for_policy_tab(self):
         """بارگذاری لیست بیمه‌نامه‌ها در تب بیمه‌نامه‌ها"""
-        company_name = self.company_combo_policy.currentText()
+        company_name = self.selected_company(self.company_combo_policy)
         self.update_policies_table(company_name)
 
     def update_policies_table(self, filter_company=None):
-        
-        policies = self.db_manager.get_policies(filter_company)
-        self.policies_table.setRowCount(len(policies))
-        
-        for row, policy in enumerate(policies):
-            company_name, policy_number, policy_date, total_value, remaining_value = policy[1], policy[2], policy[3], policy[4], policy[5]
-            
-            self.policies_table.setItem(row, 0, QTableWidgetItem(company_name))
-            self.policies_table.setItem(row, 1, QTableWidgetItem(policy_number))
-            self.policies_table.setItem(row, 2, QTableWidgetItem(policy_date))
-            self.policies_table.setItem(row, 3, QTableWidgetItem(f"{total_value:,}"))
-            self.policies_table.setItem(row, 4, QTableWidgetItem(f"{remaining_value:,}"))
-            
-            if total_value > 0:
-                percentage = (remaining_value / total_value) * 100
-                self.policies_table.setItem(row, 5, QTableWidgetItem(f"{percentage:.1f}%"))
-            else:
-                self.policies_table.setItem(row, 5, QTableWidgetItem("0%"))
+        self.policy_table_model.load(self.db_manager.get_policies(filter_company), filter_company)
+
+    def require_file_backed(self):
+        if self.db_manager.file_backed:
+            return True
+        QMessageBox.warning(self, "خطا", "این امکان فقط برای پایگاه داده SQLite در دسترس است")
+        return False
 
     def backup_database(self):
+        if not self.require_file_backed():
+            return
         file_name, _ = QFileDialog.getSaveFileName(self, "پشتیبان‌گیری", f"backup_{datetime.now().strftime('%Y%m%d')}.db", "Database Files (*.db)")
         if file_name:
             try:
-                shutil.copy2("insurance_system.db", file_name)
+                shutil.copy2(self.db_manager.db_path, file_name)
+                self.archive.backup_to(CertificateArchive.directory_for(file_name))
+                self.audit_log.record('backup', {'target': file_name, 'sha256': file_sha256(file_name)}, wait=True)
                 QMessageBox.information(self, "موفق", f"پشتیبان با موفقیت در فایل {file_name} ذخیره شد")
             except Exception as e:
                 QMessageBox.critical(self, "خطا", f"خطا در ایجاد پشتیبان: {str(e)}")
 
     def restore_database(self):
+        if not self.require_file_backed():
+            return
         file_name, _ = QFileDialog.getOpenFileName(self, "بازیابی پشتیبان", "", "Database Files (*.db)")
         if file_name and QMessageBox.question(self, "تأیید", "آیا مطمئن هستید که می‌خواهید پایگاه داده را با فایل انتخاب شده جایگزین کنید؟") == QMessageBox.StandardButton.Yes:
             try:
-                shutil.copy2(file_name, "insurance_system.db")
+                db_path = self.db_manager.db_path
+                replaced_hash = file_sha256(db_path) if os.path.exists(db_path) else None
+                self.audit_log.flush()
+                self.db_manager.close_connections()
+                shutil.copy2(file_name, db_path)
+                self.db_manager.reload()
+                self.audit_log.record('restore', {'source': file_name, 'sha256': file_sha256(db_path),
+                                                  'replaced_sha256': replaced_hash,
+                                                  'tenant': self.db_manager.tenant}, wait=True)
+                self.snapshot.request_clear()
+                self.restore_archive(file_name, db_path)
+                self.build_cottage_index()
+                self.reload_views()
                 QMessageBox.information(self, "موفق", "پایگاه داده با موفقیت بازیابی شد")
-                self.load_companies()
             except Exception as e:
                 QMessageBox.critical(self, "خطا", f"خطا در بازیابی پایگاه داده: {str(e)}")
 
+    def restore_archive(self, backup_path, db_path):
+        """بایگانی همراه پشتیبان جایگزین می‌شود؛ اگر پشتیبان بایگانی نداشته باشد اسناد گواهی‌های ناموجود حذف می‌شوند"""
+        self.archive.close()
+        source = CertificateArchive.directory_for(backup_path)
+        target = self.db_manager.tenants.archive_directory(self.db_manager.tenant)
+        if os.path.isdir(source):
+            shutil.rmtree(target, ignore_errors=True)
+            shutil.copytree(source, target)
+            self.archive = CertificateArchive(target)
+        else:
+            self.archive = CertificateArchive(target)
+            self.archive.retain_issued(db_path)
+
+    def run_reconciliation(self):
+        if not self.require_file_backed():
+            return
+        self.reconcile_btn.setEnabled(False)
+        self.reconciliation_thread = ReconciliationThread(ReconciliationEngine(self.db_manager),
+                                                          full=self.full_reconcile_check.isChecked(), parent=self)
+        self.reconciliation_thread.completed.connect(self.show_reconciliation_report)
+        self.reconciliation_thread.failed.connect(self.show_reconciliation_error)
+        self.reconciliation_thread.start()
+
+    def show_reconciliation_report(self, report):
+        self.reconcile_btn.setEnabled(True)
+        issues = ReconciliationEngine.issue_count(report)
+        box = QMessageBox(self)
+        box.setWindowTitle("بررسی یکپارچگی داده‌ها")
+        if issues:
+            box.setIcon(QMessageBox.Icon.Warning)
+            box.setText(f"{issues} مغایرت یافت شد")
+        else:
+            box.setIcon(QMessageBox.Icon.Information)
+            box.setText("مغایرتی یافت نشد")
+        box.setDetailedText(ReconciliationEngine.format_report(report))
+        box.exec()
+
+    def show_reconciliation_error(self, message):
+        self.reconcile_btn.setEnabled(True)
+        QMessageBox.critical(self, "خطا", f"خطا در بررسی یکپارچگی داده‌ها: {message}")
+
+    def reprint_certificate(self):
+        try:
+            sanad_id = int(self.reprint_sanad_edit.text().strip())
+        except ValueError:
+            QMessageBox.warning(self, "خطا", "شماره سند باید عدد معتبر باشد")
+            return
+        html = self.archive.get(sanad_id)
+        if html is None:
+            QMessageBox.warning(self, "خطا", "این سند در بایگانی یافت نشد")
+            return
+        dialog = CertificatePrintDialog(None, self, html=html)
+        dialog.exec()
+
     def load_history(self):
         # پیاده‌سازی نمایش سوابق
         pass
 
     def generate_report(self):
-        company_name = self.report_company_combo.currentText()
+        """محاسبه گزارش فقط وقتی تب گزارش باز است؛ پیش‌بینی در ForecastThread و نمایش پس از پایان آن انجام می‌شود"""
+        if self.main_content.currentWidget() is not self.report_tab:
+            return
+        if self.analytics is None:
+            self.show_report({'policy_id': []})
+            return
+        if self.forecast_thread is not None and self.forecast_thread.isRunning():
+            self.report_requested = True
+            return
+        self.report_requested = False
+        self.report_text.setPlainText("در حال محاسبه گزارش...")
+        self.forecast_thread = ForecastThread(self.analytics, parent=self)
+        self.forecast_thread.completed.connect(self.show_forecast)
+        self.forecast_thread.failed.connect(self.show_report_error)
+        self.forecast_thread.finished.connect(self.forecast_finished)
+        self.forecast_thread.start()
+
+    def show_forecast(self, forecast):
+        # نتیجه نمایندگی قبلی یا درخواستی که در حین محاسبه رسیده دور ریخته می‌شود
+        if self.forecast_thread.analytics is self.analytics and not self.report_requested:
+            self.show_report(forecast)
+
+    def show_report_error(self, message):
+        self.report_text.setPlainText(f"خطا در محاسبه گزارش: {message}")
+
+    def forecast_finished(self):
+        if self.report_requested or self.forecast_thread.analytics is not self.analytics:
+            self.generate_report()
+
+    def show_report(self, forecast):
+        company_name = self.selected_company(self.report_company_combo)
         if not company_name:
-            self.report_text.clear()
+            if self.analytics is not None:
+                self.report_text.setPlainText(self.generate_depletion_report(forecast))
             return
         
         policies = self.db_manager.get_policies(company_name)
         report_text = f"گزارش مانده بیمه‌نامه‌های شرکت {company_name}:\n\n"
+        positions = {int(policy_id): i for i, policy_id in enumerate(forecast['policy_id'])}
         
         for policy in policies:
             remaining_percent = (policy[4] / policy[3]) * 100 if policy[3] > 0 else 0
@@ -928,11 +3741,68 @@ class InsuranceSystem(QMainWindow):
             report_text += f"تاریخ: {policy[2]}\n"
             report_text += f"ارزش کل: {policy[3]:,} ریال\n"
             report_text += f"مانده: {policy[4]:,} ریال ({remaining_percent:.1f}%)\n"
+            i = positions.get(policy[0])
+            if i is not None and forecast['depletion_day'][i] >= 0:
+                report_text += f"مصرف روزانه ({self.analytics.window_days} روز اخیر): {forecast['daily_rate'][i]:,.0f} ریال\n"
+                report_text += f"تاریخ پیش‌بینی اتمام: {ordinal_to_jalali(forecast['depletion_day'][i])}\n"
+            else:
+                report_text += "تاریخ پیش‌بینی اتمام: بدون مصرف اخیر\n"
             report_text += "-" * 40 + "\n"
         
         self.report_text.setPlainText(report_text)
 
+    def generate_depletion_report(self, forecast, days=7):
+        """گزارش بیمه‌نامه‌هایی که مانده آن‌ها تا هفته آینده تمام می‌شود"""
+        depleting = self.analytics.depleting_within(days, data=forecast)
+        report_text = f"بیمه‌نامه‌هایی که تا {days} روز آینده تمام می‌شوند:\n\n"
+        if not depleting:
+            report_text += "موردی یافت نشد\n"
+        for policy_id, company_name, policy_number, remaining_value, daily_rate, depletion_day in depleting:
+            report_text += f"شرکت: {company_name} - شماره بیمه‌نامه: {policy_number}\n"
+            report_text += f"مانده: {remaining_value:,} ریال - مصرف روزانه: {daily_rate:,.0f} ریال\n"
+            report_text += f"تاریخ پیش‌بینی اتمام: {ordinal_to_jalali(depletion_day)}\n"
+            report_text += "-" * 40 + "\n"
+        return report_text
+
+def run_reconciliation_cli(argv):
+    parser = argparse.ArgumentParser(prog="insurance_system.py reconcile",
+                                     description="بررسی سازگاری مانده بیمه‌نامه‌ها و گواهی‌ها")
+    parser.add_argument("--db", default=None)
+    parser.add_argument("--tenant", default=None)
+    parser.add_argument("--full", action="store_true", help="بررسی همه بیمه‌نامه‌ها بدون توجه به اجرای قبلی")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.db:
+        db_manager = DatabaseManager(args.db)
+    else:
+        db_manager = DatabaseManager(tenants=TenantRegistry.load("tenants.json"))
+        if args.tenant:
+            db_manager.use_tenant(args.tenant)
+    engine = ReconciliationEngine(db_manager, workers=args.workers)
+    report = engine.run(full=args.full)
+    print(ReconciliationEngine.format_report(report))
+    return 1 if ReconciliationEngine.issue_count(report) else 0
+
+def run_audit_verify_cli(argv):
+    parser = argparse.ArgumentParser(prog="insurance_system.py verify-audit",
+                                     description="بررسی سلامت زنجیره هش دفتر ممیزی")
+    parser.add_argument("--log", default="insurance_system_audit.log")
+    args = parser.parse_args(argv)
+
+    ok, count, last_hash, message = verify_audit_log(args.log)
+    print(f"تعداد رکوردها: {count}")
+    print(f"آخرین هش: {last_hash}")
+    if not ok:
+        print(message)
+    return 0 if ok else 1
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "reconcile":
+        sys.exit(run_reconciliation_cli(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "verify-audit":
+        sys.exit(run_audit_verify_cli(sys.argv[2:]))
+
     app = QApplication(sys.argv)
     
     # تنظیم فونت مناسب برای فارسی
@@ -0,0 +1,79 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from insurance_system import ALLOCATION_STRATEGIES, allocate_shipment, split_count
+
+
+# (id, policy_number, policy_date, total_value, remaining_value)
+POLICIES = [
+    (1, "A", "1404/02/01", 1000, 100),
+    (2, "B", "1404/1/15", 1000, 300),
+    (3, "C", "1403/12/29", 1000, 250),
+    (4, "D", "1404/01/01", 1000, 0),
+]
+
+
+@pytest.mark.parametrize("strategy", ALLOCATION_STRATEGIES)
+def test_plan_covers_value_within_balances(strategy):
+    plan = allocate_shipment(POLICIES, 520, strategy)
+    balances = {policy[0]: policy[4] for policy in POLICIES}
+    assert sum(amount for _, amount in plan) == 520
+    assert all(0 < amount <= balances[policy_id] for policy_id, amount in plan)
+    assert len({policy_id for policy_id, _ in plan}) == len(plan)
+
+
+@pytest.mark.parametrize("strategy", ALLOCATION_STRATEGIES)
+def test_insufficient_or_empty_balance_returns_none(strategy):
+    assert allocate_shipment(POLICIES, 651, strategy) is None
+    assert allocate_shipment(POLICIES, 0, strategy) is None
+    assert allocate_shipment([(4, "D", "1404/01/01", 1000, 0)], 1, strategy) is None
+    assert allocate_shipment([], 1, strategy) is None
+
+
+def test_exact_total_balance_is_allocated():
+    assert sorted(allocate_shipment(POLICIES, 650, "oldest_first")) == [(1, 100), (2, 300), (3, 250)]
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        allocate_shipment(POLICIES, 10, "random")
+
+
+def test_oldest_first_orders_unpadded_dates():
+    assert allocate_shipment(POLICIES, 400, "oldest_first") == [(3, 250), (2, 150)]
+
+
+def test_fewest_policies_uses_largest_balances():
+    assert allocate_shipment(POLICIES, 400, "fewest_policies") == [(2, 300), (3, 100)]
+
+
+def test_best_fit_picks_smallest_covering_balance():
+    assert allocate_shipment(POLICIES, 260, "best_fit") == [(2, 260)]
+    assert allocate_shipment(POLICIES, 100, "best_fit") == [(1, 100)]
+
+
+def test_best_fit_remainder_consumes_largest_then_fits():
+    assert allocate_shipment(POLICIES, 500, "best_fit") == [(2, 300), (3, 200)]
+    assert allocate_shipment(POLICIES, 600, "best_fit") == [(2, 300), (3, 250), (1, 50)]
+
+
+def test_split_count_is_proportional_and_sums_to_count():
+    assert split_count(10, [600, 400]) == [6, 4]
+    assert split_count(10, [1, 1, 1]) == [4, 3, 3]
+    assert sum(split_count(7, [123, 456, 789])) == 7
+
+
+def test_split_count_with_fewer_packages_than_parts():
+    shares = split_count(2, [100, 300, 50, 50])
+    assert sum(shares) == 2
+    assert shares == [1, 1, 0, 0]
+    assert split_count(1, [300, 700]) == [0, 1]
+
+
+def test_split_count_edge_cases():
+    assert split_count(0, [5, 5]) == [0, 0]
+    assert split_count(5, [5]) == [5]
+    assert split_count(5, [0, 0]) == [5, 0]
@@ -0,0 +1,114 @@
+import sys
+import json
+import hashlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from insurance_system import AUDIT_GENESIS, AuditLog, verify_audit_log
+
+
+def write_log(path, count=5):
+    log = AuditLog(path)
+    for i in range(count):
+        log.record("add_company", {"name": f"company {i}"})
+    log.close()
+
+
+def read_lines(path):
+    return Path(path).read_bytes().splitlines(keepends=True)
+
+
+def test_intact_log_verifies(tmp_path):
+    path = tmp_path / "audit.log"
+    write_log(path)
+    ok, count, _, message = verify_audit_log(path)
+    assert ok, message
+    assert count == 5
+
+
+def test_reopened_log_continues_chain(tmp_path):
+    path = tmp_path / "audit.log"
+    write_log(path, 3)
+    write_log(path, 2)
+    assert verify_audit_log(path)[:2] == (True, 5)
+
+
+def test_edited_record_breaks_chain(tmp_path):
+    path = tmp_path / "audit.log"
+    write_log(path)
+    lines = read_lines(path)
+    lines[2] = lines[2].replace(b"company 2", b"company X")
+    path.write_bytes(b"".join(lines))
+    ok, count, _, _ = verify_audit_log(path)
+    assert not ok
+    assert count == 2
+
+
+def test_forged_record_with_recomputed_hash_breaks_next_line(tmp_path):
+    path = tmp_path / "audit.log"
+    write_log(path)
+    lines = read_lines(path)
+    previous = lines[1].rstrip(b"\n").rpartition(b"\t")[2]
+    body = lines[2].rpartition(b"\t")[0].replace(b"company 2", b"company X")
+    lines[2] = body + b"\t" + hashlib.sha256(previous + body).hexdigest().encode() + b"\n"
+    path.write_bytes(b"".join(lines))
+    ok, count, _, _ = verify_audit_log(path)
+    assert not ok
+    assert count == 3
+
+
+def test_forged_last_record_is_caught_by_head(tmp_path):
+    path = tmp_path / "audit.log"
+    write_log(path)
+    lines = read_lines(path)
+    previous = lines[-2].rstrip(b"\n").rpartition(b"\t")[2]
+    body = lines[-1].rpartition(b"\t")[0].replace(b"company 4", b"company X")
+    lines[-1] = body + b"\t" + hashlib.sha256(previous + body).hexdigest().encode() + b"\n"
+    path.write_bytes(b"".join(lines))
+    ok, count, _, _ = verify_audit_log(path)
+    assert not ok
+    assert count == 5
+
+
+def test_deleted_middle_record_is_detected(tmp_path):
+    path = tmp_path / "audit.log"
+    write_log(path)
+    lines = read_lines(path)
+    del lines[1]
+    path.write_bytes(b"".join(lines))
+    assert not verify_audit_log(path)[0]
+
+
+def test_truncated_tail_is_detected(tmp_path):
+    path = tmp_path / "audit.log"
+    write_log(path)
+    path.write_bytes(b"".join(read_lines(path)[:3]))
+    ok, count, _, message = verify_audit_log(path)
+    assert not ok
+    assert count == 3
+    assert "2" in message
+
+
+def test_truncated_tail_leaves_seq_gap_after_reopen(tmp_path):
+    path = tmp_path / "audit.log"
+    write_log(path)
+    path.write_bytes(b"".join(read_lines(path)[:3]))
+    write_log(path, 1)
+    last = json.loads(read_lines(path)[-1].rpartition(b"\t")[0])
+    assert last["seq"] == 6
+    assert not verify_audit_log(path)[0]
+
+
+def test_partial_last_line_is_reported(tmp_path):
+    path = tmp_path / "audit.log"
+    write_log(path)
+    path.write_bytes(path.read_bytes()[:-10])
+    ok, count, _, _ = verify_audit_log(path)
+    assert not ok
+    assert count == 4
+
+
+def test_empty_log_without_head(tmp_path):
+    path = tmp_path / "audit.log"
+    path.write_bytes(b"")
+    assert verify_audit_log(path) == (True, 0, AUDIT_GENESIS, "")